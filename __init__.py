@@ -5,6 +5,8 @@ from flask import Flask
 from flask_cors import CORS
 from config import set_config
 from dotenv import load_dotenv
+from security import tokens
+import compression, json_provider, metrics, rate_limit
 
 def create_app():
     '''
@@ -12,10 +14,21 @@ def create_app():
     '''
     load_dotenv(override=True)
     app = Flask(__name__)
+    # Plans are large lists of dicts with datetimes, the default provider spends most of a response on them.
+    app.json = json_provider.OrjsonProvider(app)
     # Enable CORS. This can be disabled in production if everything is on the same domain.
     CORS(app)
     CONFIG = set_config()
     # Set the app configuration.
     for key in CONFIG:
         app.config[key] = CONFIG[key]
+    # Parse the keys once instead of on every JWT verification and signature.
+    app.config['PUBLIC_KEY_OBJECT'] = tokens.load_public_key(app.config['PUBLIC_KEY'])
+    app.config['PRIVATE_KEY_OBJECT'] = tokens.load_private_key(app.config['SECRET_KEY'])
+    # Request timing, Server-Timing headers and the counters behind /metrics.
+    metrics.init_app(app)
+    # Registered after metrics, so response sizes are measured after compression.
+    compression.init_app(app)
+    # Per client limits for the unauthenticated routes, shared through redis when configured.
+    rate_limit.init_app(app)
     return app
\ No newline at end of file
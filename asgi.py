@@ -0,0 +1,13 @@
+'''
+ASGI entry point for serving the API with uvicorn workers (see gunicorn.conf.py).
+The Flask app is unchanged. Each request runs on a thread of the adapter's pool while the event loop keeps
+accepting connections, so one worker serves many requests that are waiting on datastore or Google.
+'''
+from os import environ
+from a2wsgi import WSGIMiddleware
+from main import app as flask_app
+
+# Requests handled at the same time by one worker.
+REQUEST_THREADS = int(environ.get('REQUEST_THREADS', 32))
+
+app = WSGIMiddleware(flask_app, workers=REQUEST_THREADS)
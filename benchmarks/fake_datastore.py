@@ -0,0 +1,244 @@
+'''
+In-memory stand-in for google.cloud.datastore.Client. Used by the benchmark harness to run the app without the
+Datastore emulator or GCP credentials.
+Only the subset of the client API used by the application is implemented: key, get, get_multi, put, put_multi,
+delete, delete_multi, query (filters, projection, keys_only, order, limit, start_cursor) and transaction.
+Entities and keys are the real datastore.Entity and datastore.Key classes.
+latency adds a sleep to every RPC, so concurrency in the app behaves as it does against the real service.
+'''
+import base64, itertools, threading, time
+
+from google.cloud import datastore
+
+
+_OPERATORS = {
+    '=': lambda a, b: a == b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    '!=': lambda a, b: a != b,
+    'IN': lambda a, b: a in b,
+}
+
+
+def _copy(entity):
+    # Values are copied one level deep, like deserializing an RPC response. deepcopy would dominate the benchmarks.
+    copied = datastore.Entity(entity.key, exclude_from_indexes=tuple(entity.exclude_from_indexes))
+    copied.update({name: value.copy() if isinstance(value, (list, dict)) else value for name, value in entity.items()})
+    return copied
+
+
+def _sort_key(key):
+    # Datastore orders keys by path; ids sort before names.
+    return tuple((part['kind'], 0 if 'id' in part else 1, part.get('id', part.get('name'))) for part in key.path)
+
+
+def _matches(entity, prop, op, value):
+    if prop == '__key__':
+        candidates = [entity.key]
+    elif prop not in entity:
+        return False
+    elif isinstance(entity[prop], list):
+        candidates = entity[prop]
+    else:
+        candidates = [entity[prop]]
+    for candidate in candidates:
+        try:
+            if _OPERATORS[op](candidate, value):
+                return True
+        except TypeError:
+            continue
+    return False
+
+
+class FakeIterator:
+    '''
+    Iterator returned by FakeQuery.fetch. Mirrors the paging attributes of the real iterator.
+    '''
+    def __init__(self, results, next_page_token, page_size=300):
+        self._results = results
+        self.next_page_token = None
+        self._final_token = next_page_token
+        self._page_size = page_size
+        self.num_results = 0
+
+    @property
+    def pages(self):
+        for start in range(0, len(self._results), self._page_size):
+            page = self._results[start:start + self._page_size]
+            self.num_results += len(page)
+            yield iter(page)
+        self.next_page_token = self._final_token
+
+    def __iter__(self):
+        for page in self.pages:
+            yield from page
+
+
+class FakeQuery:
+    '''
+    Query against the in-memory store.
+    '''
+    def __init__(self, client, kind=None, projection=(), order=(), filters=()):
+        self._client = client
+        self.kind = kind
+        self._projection = list(projection)
+        self._order = list(order)
+        self.filters = list(filters)
+        self._keys_only = False
+
+    def add_filter(self, property_name=None, operator=None, value=None, *, filter=None):
+        if filter is not None:
+            property_name, operator, value = filter.property_name, filter.operator, filter.value
+        self.filters.append((property_name, operator, value))
+        return self
+
+    @property
+    def projection(self):
+        return self._projection
+
+    @projection.setter
+    def projection(self, value):
+        self._projection = [value] if isinstance(value, str) else list(value)
+
+    @property
+    def order(self):
+        return self._order
+
+    @order.setter
+    def order(self, value):
+        self._order = [value] if isinstance(value, str) else list(value)
+
+    def keys_only(self):
+        self._projection = ['__key__']
+
+    def fetch(self, limit=None, offset=0, start_cursor=None, **kwargs):
+        self._client._rpc()
+        with self._client._lock:
+            entities = [e for e in self._client._store.values() if e.key.kind == self.kind]
+        entities.sort(key=lambda e: _sort_key(e.key))
+        for prop, op, value in self.filters:
+            entities = [e for e in entities if _matches(e, prop, op, value)]
+        for prop in reversed(self._order):
+            reverse = prop.startswith('-')
+            prop = prop.lstrip('-')
+            entities = [e for e in entities if prop in e]
+            entities.sort(key=lambda e: e[prop], reverse=reverse)
+        for prop in self._projection:
+            if prop != '__key__':
+                entities = [e for e in entities if prop in e]
+
+        start = offset
+        if start_cursor:
+            start = int(base64.urlsafe_b64decode(start_cursor).decode())
+        end = len(entities) if limit is None else start + limit
+        token = None
+        if limit is not None:
+            token = base64.urlsafe_b64encode(str(min(end, len(entities))).encode())
+
+        results = []
+        for entity in entities[start:end]:
+            if self._projection:
+                copied = datastore.Entity(entity.key)
+                copied.update({p: entity[p] for p in self._projection if p != '__key__'})
+            else:
+                copied = _copy(entity)
+            results.append(copied)
+        return FakeIterator(results, token)
+
+
+class FakeTransaction:
+    '''
+    Serializes transactional blocks with the client lock. Writes are applied immediately.
+    '''
+    def __init__(self, client):
+        self._client = client
+
+    def __enter__(self):
+        self._client._tx_lock.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self._client._tx_lock.release()
+        return False
+
+    def put(self, entity):
+        self._client.put(entity)
+
+    def delete(self, key):
+        self._client.delete(key)
+
+
+class FakeClient:
+    '''
+    Drop-in replacement for datastore.Client backed by a dict.
+    Arguments:
+        project: str
+        latency: float, seconds added to every RPC
+    '''
+    def __init__(self, project='fake-project', *args, latency=0.0, **kwargs):
+        self.project = project
+        self.latency = latency
+        self._store = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._tx_lock = threading.RLock()
+        self.rpc_count = 0
+
+    def _rpc(self):
+        with self._lock:
+            self.rpc_count += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def key(self, *path_args, **kwargs):
+        return datastore.Key(*path_args, project=self.project, **kwargs)
+
+    def query(self, kind=None, projection=(), order=(), filters=(), **kwargs):
+        return FakeQuery(self, kind=kind, projection=projection, order=order, filters=filters)
+
+    def transaction(self, **kwargs):
+        return FakeTransaction(self)
+
+    def get(self, key, **kwargs):
+        found = self.get_multi([key])
+        return found[0] if found else None
+
+    def get_multi(self, keys, missing=None, **kwargs):
+        self._rpc()
+        found = []
+        with self._lock:
+            for key in keys:
+                entity = self._store.get(key)
+                if entity is None:
+                    if missing is not None:
+                        missing.append(datastore.Entity(key))
+                    continue
+                found.append(_copy(entity))
+        return found
+
+    def put(self, entity, **kwargs):
+        self.put_multi([entity])
+
+    def put_multi(self, entities, **kwargs):
+        self._rpc()
+        with self._lock:
+            for entity in entities:
+                if entity.key.is_partial:
+                    entity.key = entity.key.completed_key(next(self._ids))
+                self._store[entity.key] = _copy(entity)
+
+    def delete(self, key, **kwargs):
+        self.delete_multi([key])
+
+    def delete_multi(self, keys, **kwargs):
+        self._rpc()
+        with self._lock:
+            for key in keys:
+                if not isinstance(key, datastore.Key):
+                    raise ValueError('delete expects a datastore.Key')
+                self._store.pop(key, None)
+
+    def allocate_ids(self, incomplete_key, num_ids, **kwargs):
+        return [incomplete_key.completed_key(next(self._ids)) for _ in range(num_ids)]
@@ -0,0 +1,324 @@
+'''
+Load test for the API. Boots the app from main.py against an in-memory datastore (fake_datastore.py) or the
+Datastore emulator, and a local stub of Google's OAuth endpoints (stub_google.py). Seeds plans and users, then
+replays a mix of plan reads, recommendations, logins and admin writes from concurrent clients.
+Reports requests, errors, p50/p95/p99 latency and throughput per route.
+Save a run with --save and compare later runs with --baseline. The script exits with status 1 when a route's p95
+got slower than the baseline by more than --tolerance or started failing.
+Run from the project root: python benchmarks/load_test.py --plans 2000 --users 500 --requests 5000
+With the emulator: DATASTORE_EMULATOR_HOST=localhost:8081 python benchmarks/load_test.py --emulator
+'''
+import argparse, contextlib, datetime, io, json, os, random, sys, threading, time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS))
+sys.path.insert(0, BENCHMARKS)
+import jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from google.cloud import datastore
+import fake_datastore, recommend_engine, stub_google
+
+# Relative weight of each scenario in the default mix.
+DEFAULT_MIX = {'list_plans': 30, 'get_plan': 20, 'recommend': 37, 'login': 12, 'admin_write': 1}
+
+# Share of logins by users that don't exist yet.
+NEW_USER_RATE = 0.1
+
+
+def percentile(values, fraction):
+    '''
+    Nearest-rank percentile of sorted values.
+    '''
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))]
+
+
+def parse_mix(value):
+    '''
+    Parse a mix like "list_plans=50,recommend=50".
+    '''
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f'unknown scenario {name}, use {", ".join(DEFAULT_MIX)}')
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def prepare_environment(args):
+    '''
+    Give the app the settings it needs without a .env file. Existing environment variables are kept.
+    '''
+    if not os.environ.get('PRIVATE_KEY'):
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        os.environ['PRIVATE_KEY'] = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                                      serialization.NoEncryption()).decode()
+        os.environ['PUBLIC_KEY'] = key.public_key().public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo).decode()
+    os.environ.setdefault('GOOGLE_AUTH_CLIENT_ID', 'benchmark-client')
+    os.environ.setdefault('GOOGLE_AUTH_CLIENT_SECRET', 'benchmark-secret')
+    if not args.emulator:
+        # The app creates its clients at import time, so every datastore.Client() must return the fake.
+        shared = fake_datastore.FakeClient(latency=args.datastore_latency / 1000)
+        datastore.Client = lambda *a, **k: shared
+
+
+def seed(client, plans, users):
+    '''
+    Store a synthetic catalog and users.
+    Returns:
+        list: plan ids
+        list: user subs
+    '''
+    import pricing
+    entities = []
+    for i, data in enumerate(recommend_engine.synthetic_catalog(plans)):
+        data.update({'networks': ['5G', 'LTE'], 'description': f'Synthetic plan {i} ' * 8, 'payoff': i % 3 == 0,
+                     'url': f'https://example.com/plans/{i}', 'date_added': datetime.datetime.now(datetime.timezone.utc)})
+        data['price_table'] = pricing.build_price_table(data['price'])
+        entity = datastore.Entity(client.key('plans'))
+        entity.update(data)
+        entities.append(entity)
+    subs = [str(100000 + i) for i in range(users)]
+    for sub in subs:
+        entity = datastore.Entity(client.key('users', sub))
+        entity.update({'sub': sub, 'email': f'{sub}@example.com', 'name': f'User {sub}', 'roles': ['user']})
+        entities.append(entity)
+    for start in range(0, len(entities), 500):
+        client.put_multi(entities[start:start + 500])
+    return [entity.key.id for entity in entities if entity.key.kind == 'plans'], subs
+
+
+class Scenarios:
+    '''
+    The requests a client sends. Each scenario returns (route, status, seconds) for every request it made.
+    '''
+    def __init__(self, plan_ids, subs, admin_token):
+        self.plan_ids = plan_ids
+        self.subs = subs
+        self.admin = {'Authorization': f'Bearer {admin_token}'}
+        self.created = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def timed(route, call):
+        '''
+        Returns:
+            tuple: route, status, seconds
+            flask.Response
+        '''
+        start = time.perf_counter()
+        response = call()
+        # Streamed responses are only produced while the body is read.
+        response.get_data()
+        return (route, response.status_code, time.perf_counter() - start), response
+
+    def list_plans(self, http, rng):
+        if rng.random() < 0.3:
+            fields = 'name,carrier,data,hotspot,talk,text'
+            return [self.timed('GET /plans?fields', lambda: http.get(f'/plans?fields={fields}'))[0]]
+        return [self.timed('GET /plans', lambda: http.get('/plans'))[0]]
+
+    def get_plan(self, http, rng):
+        plan_id = rng.choice(self.plan_ids)
+        return [self.timed('GET /plans/<id>', lambda: http.get(f'/plans/{plan_id}'))[0]]
+
+    def recommend(self, http, rng):
+        body = recommend_engine.synthetic_requests(1, seed=rng.random())[0]
+        if rng.random() < 0.3:
+            body['sort'] = 'score'
+        return [self.timed('POST /recommend', lambda: http.post('/recommend?limit=20', json=body))[0]]
+
+    def login(self, http, rng):
+        sub = rng.choice(self.subs) if rng.random() > NEW_USER_RATE else str(rng.randrange(10 ** 9))
+        result, response = self.timed('GET /auth/initiate', lambda: http.get('/auth/initiate'))
+        results = [result]
+        if response.status_code == 200:
+            state = response.get_json()['state']
+            results.append(self.timed('POST /auth/callback',
+                                      lambda: http.post('/auth/callback', json={'code': sub, 'state': state}))[0])
+        return results
+
+    def admin_write(self, http, rng):
+        choice = rng.random()
+        if choice < 0.4:
+            plan = recommend_engine.synthetic_catalog(1, seed=rng.random())[0]
+            plan.update({'name': f'Load test plan {rng.randrange(10 ** 12)}', 'networks': ['5G'],
+                         'description': 'Created by the load test', 'payoff': False, 'url': 'https://example.com'})
+            result, response = self.timed('POST /plans', lambda: http.post('/plans', json=plan, headers=self.admin))
+            if response.status_code == 201:
+                # Created plans are deleted by later writes, so the catalog size stays about the same.
+                with self.lock:
+                    self.created.append(response.get_json()['id'])
+            return [result]
+        if choice < 0.7:
+            with self.lock:
+                plan_id = self.created.pop() if self.created else None
+            if plan_id is not None:
+                return [self.timed('DELETE /plans/<id>',
+                                   lambda: http.delete(f'/plans/{plan_id}', headers=self.admin))[0]]
+        plan_id = rng.choice(self.plan_ids)
+        patch = {'description': f'Updated {rng.random()}'}
+        return [self.timed('PATCH /plans/<id>',
+                           lambda: http.patch(f'/plans/{plan_id}', json=patch, headers=self.admin))[0]]
+
+
+def run(app, scenarios, mix, total, concurrency, duration, seed_value):
+    '''
+    Send requests from concurrent clients until total scenarios ran or duration seconds passed.
+    Returns:
+        list: (route, status, seconds)
+        float: wall clock seconds
+    '''
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    results = []
+    lock = threading.Lock()
+    remaining = [total]
+    deadline = time.perf_counter() + duration if duration else None
+
+    def client(index):
+        rng = random.Random(seed_value + index)
+        http = app.test_client()
+        local = []
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+            if deadline and time.perf_counter() > deadline:
+                break
+            scenario = getattr(scenarios, rng.choices(names, weights)[0])
+            local.extend(scenario(http, rng))
+        with lock:
+            results.extend(local)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+
+def summarize(results, elapsed):
+    '''
+    Latency and throughput per route.
+    Returns:
+        dict: route -> {requests, errors, rps, p50, p95, p99} with latencies in milliseconds
+    '''
+    routes = {}
+    for route, status, seconds in results:
+        routes.setdefault(route, []).append((status, seconds))
+    summary = {}
+    for route, samples in sorted(routes.items()):
+        latencies = sorted(seconds * 1000 for _, seconds in samples)
+        summary[route] = {
+            'requests': len(samples),
+            'errors': sum(1 for status, _ in samples if status >= 400),
+            'rps': round(len(samples) / elapsed, 1),
+            'p50': round(percentile(latencies, 0.50), 2),
+            'p95': round(percentile(latencies, 0.95), 2),
+            'p99': round(percentile(latencies, 0.99), 2),
+        }
+    return summary
+
+
+def print_report(summary, elapsed):
+    print(f'{"route":<22}{"requests":>10}{"errors":>8}{"req/s":>9}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+    for route, row in summary.items():
+        print(f'{route:<22}{row["requests"]:>10}{row["errors"]:>8}{row["rps"]:>9}'
+              f'{row["p50"]:>10}{row["p95"]:>10}{row["p99"]:>10}')
+    total = sum(row['requests'] for row in summary.values())
+    print(f'{total} requests in {elapsed:.2f}s, {total / elapsed:.1f} req/s')
+
+
+def regressions(summary, baseline, tolerance):
+    '''
+    Routes that got slower or started failing compared to a saved run.
+    Returns:
+        list: messages
+    '''
+    found = []
+    for route, row in summary.items():
+        before = baseline.get(route)
+        if not before:
+            continue
+        if row['p95'] > before['p95'] * (1 + tolerance):
+            found.append(f'{route}: p95 {before["p95"]} ms -> {row["p95"]} ms')
+        if row['errors'] and not before['errors']:
+            found.append(f'{route}: {row["errors"]} errors, none in the baseline')
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--plans', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--requests', type=int, default=5000, help='scenarios to run')
+    parser.add_argument('--duration', type=float, default=0, help='stop after this many seconds')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX)
+    parser.add_argument('--datastore-latency', type=float, default=5, help='ms per fake datastore RPC')
+    parser.add_argument('--google-latency', type=float, default=50, help='ms per stub token exchange')
+    parser.add_argument('--emulator', action='store_true', help='use the Datastore emulator instead of the fake')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare with results saved by --save')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed p95 slowdown, 0.25 = 25%%')
+    args = parser.parse_args()
+
+    prepare_environment(args)
+    # Importing main creates the app with create_app() and the app's datastore clients.
+    with contextlib.redirect_stdout(io.StringIO()):
+        import main as api
+        from google.oauth2 import id_token as google_id_token
+        from security import google_oauth
+    app = api.app
+
+    stub = stub_google.StubGoogle(app.config['GOOGLE_AUTH_CLIENT_ID'], latency=args.google_latency / 1000)
+    stub_url = stub.start()
+    app.config['GOOGLE_AUTH_TOKEN_URI'] = f'{stub_url}/token'
+    # Every simulated client comes from the same address.
+    app.config['RATE_LIMITS'] = {}
+    # verify_oauth2_token reads the certs URL from this module attribute.
+    google_id_token._GOOGLE_OAUTH2_CERTS_URL = f'{stub_url}/certs'
+    google_oauth.GOOGLE_CERTS_URL = f'{stub_url}/certs'
+
+    start = time.perf_counter()
+    plan_ids, subs = seed(api.client, args.plans, args.users)
+    api.catalog.bump_version()
+    print(f'Seeded {len(plan_ids)} plans and {len(subs)} users in {time.perf_counter() - start:.2f}s')
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    admin_token = jwt.encode({'sub': 'load-test', 'email': 'load-test@example.com', 'name': 'Load test',
+                              'roles': ['admin'], 'iat': now, 'exp': now + datetime.timedelta(hours=1)},
+                             app.config['PRIVATE_KEY_OBJECT'], algorithm=app.config['JWT_ALGORITHM'])
+    scenarios = Scenarios(plan_ids, subs, admin_token)
+
+    # The routes print debugging output. Keep it out of the report.
+    with contextlib.redirect_stdout(io.StringIO()):
+        results, elapsed = run(app, scenarios, args.mix, args.requests, args.concurrency, args.duration, args.seed)
+    summary = summarize(results, elapsed)
+    print_report(summary, elapsed)
+    print(f'Stub Google requests: {stub.requests}')
+    stub.stop()
+
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(summary, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            found = regressions(summary, json.load(file), args.tolerance)
+        for message in found:
+            print(f'REGRESSION {message}')
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+'''
+Benchmark for the in-memory recommendation engine against a synthetic catalog.
+Compares RecommendationEngine with a linear scan that applies the same filters the recommend route used to apply
+after its datastore query, and checks that both return the same plans.
+Run from the project root: python benchmarks/recommend_engine.py --plans 100000
+'''
+import argparse, os, random, statistics, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import recommender
+
+CARRIERS = ['Verizon', 'AT&T', 'T-Mobile', 'US Mobile', 'Visible', 'Mint Mobile', 'Cricket', 'Boost']
+DATA_TIERS = [1, 5, 10, 15, 30, 50, 100, 999]
+HOTSPOT_TIERS = [0, 5, 10, 15, 30, 50, 60]
+TALK_TIERS = [500, 1000, 5000, 99999]
+
+
+def synthetic_catalog(size, seed=0):
+    '''
+    Generate plans shaped like the plans kind.
+    Arguments:
+        size: int
+        seed: int
+    Returns:
+        list: plans
+    '''
+    rng = random.Random(seed)
+    plans = []
+    for i in range(size):
+        max_lines = rng.randint(1, 6)
+        plans.append({
+            'name': f'Plan {i}',
+            'carrier': rng.choice(CARRIERS),
+            'data': rng.choice(DATA_TIERS),
+            'hotspot': rng.choice(HOTSPOT_TIERS),
+            'talk': rng.choice(TALK_TIERS),
+            'text': rng.choice(TALK_TIERS),
+            'price': {str(lines): f'${lines * rng.randint(20, 90)}' for lines in range(1, max_lines + 1)},
+        })
+    return plans
+
+
+def synthetic_requests(count, seed=1):
+    '''
+    Generate recommend request bodies with a mix of thresholds and carrier lists.
+    '''
+    rng = random.Random(seed)
+    bodies = []
+    for _ in range(count):
+        body = {'lines': rng.randint(1, 6)}
+        for field, tiers in [('data', DATA_TIERS), ('hotspot', HOTSPOT_TIERS), ('talk', TALK_TIERS), ('text', TALK_TIERS)]:
+            if rng.random() < 0.6:
+                body[field] = rng.choice(tiers)
+        if rng.random() < 0.5:
+            body['carriers'] = rng.sample(CARRIERS, rng.randint(1, 3))
+        bodies.append(body)
+    return bodies
+
+
+def linear_scan(plans, body):
+    '''
+    Reference implementation: filter every plan in python.
+    '''
+    results = plans
+    for field in recommender.ALLOWANCE_FIELDS:
+        if field in body:
+            results = [plan for plan in results if plan[field] >= body[field]]
+    if 'carriers' in body:
+        results = [plan for plan in results if plan['carrier'] in body['carriers']]
+    return [plan for plan in results if str(body['lines']) in plan['price']]
+
+
+def engine_query(engine, body):
+    minimums = {field: body[field] for field in recommender.ALLOWANCE_FIELDS if field in body}
+    return engine.recommend(body['lines'], carriers=body.get('carriers'), minimums=minimums)
+
+
+def time_queries(function, target, bodies):
+    '''
+    Time every request body separately.
+    Returns:
+        list: seconds per query
+    '''
+    timings = []
+    for body in bodies:
+        start = time.perf_counter()
+        function(target, body)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    p99 = timings[int(len(timings) * 0.99) - 1]
+    print(f'{name:<14} median {statistics.median(timings) * 1e6:10.1f} us   p99 {p99 * 1e6:10.1f} us')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--plans', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args()
+
+    plans = synthetic_catalog(args.plans)
+    bodies = synthetic_requests(args.queries)
+
+    start = time.perf_counter()
+    engine = recommender.RecommendationEngine(plans)
+    print(f'{args.plans} plans, engine built in {(time.perf_counter() - start) * 1000:.1f} ms')
+
+    matches = []
+    for body in bodies:
+        expected = [id(plan) for plan in linear_scan(plans, body)]
+        actual = [id(plan) for plan in engine_query(engine, body)]
+        if expected != actual:
+            sys.exit(f'Mismatch for {body}')
+        matches.append(len(actual))
+    print(f'{args.queries} queries, median {statistics.median(matches):.0f} matching plans per query')
+
+    report('linear scan', time_queries(linear_scan, plans, bodies))
+    report('engine', time_queries(engine_query, engine, bodies))
+
+
+if __name__ == '__main__':
+    main()
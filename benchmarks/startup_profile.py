@@ -0,0 +1,113 @@
+'''
+Cold start profile of the API. Every run starts a fresh python process and measures:
+    import: importing main.py, which creates the app with create_app()
+    warmup: the /_ah/warmup request (datastore client, catalog, engine, Google certs)
+    first_request: the first GET /plans after warmup
+The slowest modules come from python -X importtime. Runs use the in-memory datastore (fake_datastore.py) and the
+stub Google endpoints (stub_google.py), so the numbers measure the app and not the network.
+Append runs to a history file with --history to track cold start time across commits.
+Run from the project root: python benchmarks/startup_profile.py --runs 5 --history startup_history.jsonl
+'''
+import argparse, json, os, statistics, subprocess, sys, time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCHMARKS)
+sys.path.insert(0, BENCHMARKS)
+import load_test
+
+# Runs in the child process. Timing starts before anything from the app is imported.
+CHILD = '''
+import json, sys, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+
+import fake_datastore, load_test, stub_google
+from google.cloud import datastore
+from google.oauth2 import id_token as google_id_token
+from security import google_oauth
+shared = fake_datastore.FakeClient()
+datastore.Client = lambda *a, **k: shared
+load_test.seed(shared, PLANS, 0)
+stub = stub_google.StubGoogle(main.app.config['GOOGLE_AUTH_CLIENT_ID'])
+url = stub.start()
+google_id_token._GOOGLE_OAUTH2_CERTS_URL = google_oauth.GOOGLE_CERTS_URL = url + '/certs'
+
+http = main.app.test_client()
+ready = time.perf_counter()
+status = http.get('/_ah/warmup').status_code
+warmed = time.perf_counter()
+http.get('/plans').get_data()
+served = time.perf_counter()
+print(json.dumps({'import': imported - start, 'warmup': warmed - ready, 'first_request': served - warmed,
+                  'warmup_status': status}))
+'''
+
+
+def child_environment():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT, BENCHMARKS, env.get('PYTHONPATH', '')])
+    return env
+
+
+def measure(plans):
+    '''
+    Start the app in a new process.
+    Returns:
+        dict: seconds for import, warmup and first_request
+    '''
+    code = f'PLANS = {plans}\n' + CHILD
+    result = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=child_environment(),
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(count):
+    '''
+    Modules imported by main, or by the modules main imports, with the highest cumulative import time.
+    Returns:
+        list: (milliseconds, module)
+    '''
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'], cwd=ROOT,
+                            env=child_environment(), capture_output=True, text=True, check=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Nesting is shown by two spaces per level. Deeper modules are included in their parents' time.
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth in (1, 2):
+            modules.append((int(cumulative) / 1000, name.strip()))
+    return sorted(modules, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--plans', type=int, default=2000)
+    parser.add_argument('--top', type=int, default=15, help='slowest imports to list')
+    parser.add_argument('--history', help='append the medians to this JSON lines file')
+    args = parser.parse_args()
+
+    # Keys are generated once and shared by every run, like environment variables on App Engine.
+    load_test.prepare_environment(argparse.Namespace(emulator=True))
+    runs = [measure(args.plans) for _ in range(args.runs)]
+    medians = {phase: statistics.median(run[phase] for run in runs) for phase in ('import', 'warmup', 'first_request')}
+    for phase, seconds in medians.items():
+        print(f'{phase:<14} median {seconds * 1000:8.1f} ms   max {max(run[phase] for run in runs) * 1000:8.1f} ms')
+
+    print('\nSlowest imports of main (cumulative):')
+    for milliseconds, module in slowest_imports(args.top):
+        print(f'{milliseconds:8.1f} ms  {module}')
+
+    if args.history:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True)
+        entry = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit.stdout.strip(), 'runs': args.runs,
+                 'plans': args.plans, **{f'{phase}_ms': round(seconds * 1000, 1) for phase, seconds in medians.items()}}
+        with open(args.history, 'a') as file:
+            file.write(json.dumps(entry) + '\n')
+
+
+if __name__ == '__main__':
+    main()
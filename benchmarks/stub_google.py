@@ -0,0 +1,122 @@
+'''
+Local stand-in for Google's OAuth token endpoint and signing certificate endpoint. Used by the load test so the
+login flow can run without Google, and by the tests of security/google_oauth.py.
+POST /token answers any authorization code with an ID token for the sub given as the code.
+GET /certs serves the certificate that signs the ID tokens, with a Cache-Control max-age like Google's.
+Classes: StubGoogle
+'''
+import datetime, json, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import jwt
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+
+KEY_ID = 'stub'
+ISSUER = 'https://accounts.google.com'
+CERTS_MAX_AGE = 21600
+
+
+def _self_signed_cert(key):
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'stub-google')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1)).not_valid_after(now + datetime.timedelta(days=1))
+            .sign(key, hashes.SHA256()))
+    return cert.public_bytes(serialization.Encoding.PEM).decode()
+
+
+class _Server(ThreadingHTTPServer):
+    # The default backlog of 5 resets connections under a login burst.
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class StubGoogle:
+    '''
+    Token and certificate server on a free local port. Runs in a daemon thread.
+    Arguments:
+        client_id: str, audience of the issued ID tokens
+        latency: float, seconds added to every token exchange, like the round trip to Google
+        certs_max_age: int, Cache-Control max-age of the certificates in seconds
+    '''
+    def __init__(self, client_id, latency=0.0, certs_max_age=CERTS_MAX_AGE):
+        self.client_id = client_id
+        self.latency = latency
+        self.certs_max_age = certs_max_age
+        self.key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.cert = _self_signed_cert(self.key)
+        self.requests = {'token': 0, 'certs': 0}
+        # TCP connections accepted, fewer than requests when clients keep connections alive.
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    def id_token(self, sub):
+        '''
+        Sign an ID token like the ones Google returns.
+        Arguments:
+            sub: str
+        Returns:
+            str: id_token
+        '''
+        now = int(time.time())
+        claims = {'iss': ISSUER, 'aud': self.client_id, 'sub': sub, 'email': f'{sub}@example.com',
+                  'name': f'User {sub}', 'iat': now, 'exp': now + 3600}
+        return jwt.encode(claims, self.key, algorithm='RS256', headers={'kid': KEY_ID})
+
+    def start(self):
+        '''
+        Start serving.
+        Returns:
+            str: base URL, e.g. http://127.0.0.1:8123
+        '''
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                # One handler per connection, it serves every request sent on it.
+                super().setup()
+                with stub._lock:
+                    stub.connections += 1
+
+            def _send(self, body, headers=()):
+                body = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                with stub._lock:
+                    stub.requests['certs'] += 1
+                self._send({KEY_ID: stub.cert}, [('Cache-Control', f'public, max-age={stub.certs_max_age}')])
+
+            def do_POST(self):
+                form = parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode())
+                with stub._lock:
+                    stub.requests['token'] += 1
+                if stub.latency:
+                    time.sleep(stub.latency)
+                sub = form.get('code', ['0'])[0]
+                self._send({'id_token': stub.id_token(sub), 'access_token': 'stub', 'token_type': 'Bearer'})
+
+        self._server = _Server(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f'http://127.0.0.1:{self._server.server_address[1]}'
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
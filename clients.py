@@ -0,0 +1,37 @@
+'''
+Shared clients for external services, created on first use.
+Creating a datastore.Client looks up credentials (a metadata server call on App Engine) and sets up the gRPC
+channel. main.py and utils.py used to create one each at import time, so a cold start paid for both before the first
+request. Now every module shares one client, created by the first request or by the warmup request.
+Classes: LazyClient
+Functions: get_datastore
+'''
+import threading
+from google.cloud import datastore
+import metrics
+
+_datastore = None
+_lock = threading.Lock()
+
+
+def get_datastore():
+    '''
+    Get the shared datastore client, creating it on first use. RPCs are counted and timed by metrics.
+    Returns:
+        metrics.InstrumentedClient
+    '''
+    global _datastore
+    if _datastore is None:
+        with _lock:
+            if _datastore is None:
+                _datastore = metrics.InstrumentedClient(datastore.Client())
+    return _datastore
+
+
+class LazyClient:
+    '''
+    Stands in for the shared datastore client at module level. The client is created on first attribute access.
+    Usage: client = clients.LazyClient()
+    '''
+    def __getattr__(self, name):
+        return getattr(get_datastore(), name)
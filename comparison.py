@@ -0,0 +1,58 @@
+'''
+Side by side comparison of plans for the compare route.
+Prices are laid out as one row per line count with a column per plan, so totals, price per line, deltas against the
+baseline plan and the cheapest plan per line count all come from one pass over each row.
+Functions: compare
+'''
+import pricing
+from recommender import ALLOWANCE_FIELDS
+
+
+def _line_counts(tables, lines):
+    if lines is not None:
+        return [str(lines)]
+    counts = {count for table in tables for count in table}
+    return sorted(counts, key=int)
+
+
+def compare(plans, baseline=0, lines=None):
+    '''
+    Compare plans against a baseline plan.
+    Arguments:
+        plans: list of plans (dict with id)
+        baseline: int, position of the baseline plan in plans
+        lines: int (optional), only compare this line count
+    Returns:
+        dict: baseline (id), lines (line counts), cheapest ({lines: id}),
+              plans (one dict per plan: id, price, price_per_line, price_delta, allowance_delta)
+        Prices are None where a plan has no price for that line count.
+    '''
+    tables = [pricing.get_price_table(plan) for plan in plans]
+    line_counts = _line_counts(tables, lines)
+    results = [{'id': plan.get('id'), 'price': {}, 'price_per_line': {}, 'price_delta': {}, 'allowance_delta': {}}
+               for plan in plans]
+    cheapest = {}
+
+    for count in line_counts:
+        row = [table.get(count) for table in tables]
+        base = row[baseline]
+        priced = [(price, i) for i, price in enumerate(row) if price is not None]
+        cheapest[count] = plans[min(priced)[1]].get('id') if priced else None
+        for result, price in zip(results, row):
+            result['price'][count] = price
+            result['price_per_line'][count] = None if price is None else round(price / int(count), 2)
+            result['price_delta'][count] = None if price is None or base is None else round(price - base, 2)
+
+    for field in ALLOWANCE_FIELDS:
+        base = plans[baseline].get(field)
+        for result, plan in zip(results, plans):
+            value = plan.get(field)
+            numeric = isinstance(value, int) and isinstance(base, int)
+            result['allowance_delta'][field] = value - base if numeric else None
+
+    return {
+        'baseline': plans[baseline].get('id'),
+        'lines': line_counts,
+        'cheapest': cheapest,
+        'plans': results,
+    }
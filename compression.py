@@ -0,0 +1,97 @@
+'''
+Response compression, hooked into the app by create_app.
+JSON responses of at least COMPRESS_MIN_SIZE bytes are compressed with brotli or gzip, whichever the client
+prefers in Accept-Encoding (brotli on a tie). Plan responses repeat the same keys for every plan, so they shrink
+to a small fraction of their size.
+Responses built from the cached catalog set a compression key (set_key). Their compressed bodies are kept and reused
+until the catalog version changes the key, so the catalog isn't compressed again on every request.
+Streamed (NDJSON) responses are sent uncompressed.
+Functions: init_app, set_key, stats
+'''
+import gzip, threading
+import brotli
+from cachetools import LRUCache
+from flask import g, request
+
+COMPRESSIBLE = ('application/json', 'text/html', 'text/plain')
+
+# Cached bodies are compressed once, so they get a slower, denser setting than per request compression.
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+BROTLI_CACHED_QUALITY = 9
+
+_cache = None
+_lock = threading.Lock()
+_counters = {'hits': 0, 'misses': 0}
+
+
+def set_key(key):
+    '''
+    Mark the response of the current request as reusable. Responses with the same key must have the same body.
+    Arguments:
+        key: hashable, e.g. the response ETag, must change when the body changes
+    '''
+    g.compress_key = key
+
+
+def stats():
+    '''
+    Get the counters of the compressed body cache.
+    Returns:
+        dict: hits, misses, size (bytes), maxsize (bytes)
+    '''
+    with _lock:
+        return dict(_counters, size=_cache.currsize if _cache else 0, maxsize=_cache.maxsize if _cache else 0)
+
+
+def _compress(body, encoding, cached):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_CACHED_QUALITY if cached else BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def _weak(response):
+    # Compressed and identity bodies share the ETag. A weak ETag says they are equivalent but not byte equal.
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+
+
+def init_app(app):
+    '''
+    Compress the responses of the app.
+    Arguments:
+        app: Flask
+    '''
+    global _cache
+    _cache = LRUCache(maxsize=app.config['COMPRESS_CACHE_BYTES'], getsizeof=len)
+    min_size = app.config['COMPRESS_MIN_SIZE']
+
+    @app.after_request
+    def compress(response):
+        if (response.status_code != 200 or response.is_streamed or response.direct_passthrough
+                or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE):
+            return response
+        response.vary.add('Accept-Encoding')
+        if (response.content_length or 0) < min_size:
+            return response
+        encoding = request.accept_encodings.best_match(['br', 'gzip'])
+        if encoding is None:
+            return response
+
+        key = g.get('compress_key')
+        body = None
+        if key is not None:
+            key = (key, encoding)
+            with _lock:
+                body = _cache.get(key)
+                _counters['hits' if body is not None else 'misses'] += 1
+        if body is None:
+            body = _compress(response.get_data(), encoding, cached=key is not None)
+            if key is not None and len(body) <= _cache.maxsize:
+                with _lock:
+                    _cache[key] = body
+        response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+        _weak(response)
+        return response
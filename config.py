@@ -26,6 +26,68 @@ def set_config():
         'JWT_ALGORITHM': 'RS256',
         'PRIVATE_KEY': environ.get('PRIVATE_KEY'),
         'PUBLIC_KEY': environ.get('PUBLIC_KEY'),
+        # HMAC key for OAuth state tokens. Derived from PRIVATE_KEY when not set.
+        'STATE_SECRET': environ.get('STATE_SECRET'),
+        # Seconds an OAuth state stays valid.
+        'STATE_TTL': 3600,
+        # Seconds a worker serves its cached plans before checking the catalog version in datastore.
+        'PLAN_CACHE_TTL': int(environ.get('PLAN_CACHE_TTL', 60)),
+        # Seconds after which a worker reloads every plan, in case plans were written without bumping the version.
+        'PLAN_CACHE_MAX_AGE': int(environ.get('PLAN_CACHE_MAX_AGE', 900)),
+        # Seconds a worker reuses a user's roles before reading them from datastore again.
+        'USER_ROLES_CACHE_TTL': int(environ.get('USER_ROLES_CACHE_TTL', 300)),
+        # Threads shared by routes that run independent datastore or HTTP calls at the same time.
+        'IO_THREADS': int(environ.get('IO_THREADS', 16)),
+        # Bearer token for scraping /metrics. Admin JWTs are accepted when not set.
+        'METRICS_TOKEN': environ.get('METRICS_TOKEN'),
+        # Send per request timings in the Server-Timing header. Off by default, it shows internals to any client.
+        'SERVER_TIMING': environ.get('SERVER_TIMING', 'false').lower() == 'true',
+        # Smallest response body in bytes worth compressing, and the memory for reused compressed bodies.
+        'COMPRESS_MIN_SIZE': int(environ.get('COMPRESS_MIN_SIZE', 1024)),
+        'COMPRESS_CACHE_BYTES': 32 * 1024 * 1024,
+        # Connect and read timeouts in seconds for outbound calls to Google.
+        'HTTP_TIMEOUT': (3.05, 10),
+        # Expired state cleanup: keys per delete_multi, pause between batches and time limit of one cron run.
+        'STATE_GC_BATCH_SIZE': 500,
+        'STATE_GC_PAUSE': 0.5,
+        'STATE_GC_MAX_SECONDS': 300,
+        # Cache-Control for GET /plans and GET /plans/<plan_id>. Lets a CDN in front of the app serve repeat reads.
+        'PLANS_CACHE_CONTROL': environ.get('PLANS_CACHE_CONTROL', 'public, max-age=60, stale-while-revalidate=60'),
+        # Page size for GET /plans when a cursor is sent without a limit, and the largest limit accepted.
+        'PLANS_DEFAULT_LIMIT': 20,
+        'PLANS_MAX_LIMIT': 500,
+        # Page size for /recommend when a cursor is sent without a limit, and the largest limit accepted.
+        'RECOMMEND_DEFAULT_LIMIT': 10,
+        'RECOMMEND_MAX_LIMIT': 100,
+        # Number of distinct /recommend responses each worker keeps in memory.
+        'RECOMMEND_CACHE_SIZE': int(environ.get('RECOMMEND_CACHE_SIZE', 1024)),
+        # /recommend requests answered from precomputed responses: every combination of these values.
+        # None means no minimum for an allowance field. limit is the page size. Empty to turn it off.
+        'RECOMMEND_PROFILES': {
+            'lines': [1, 2, 3, 4, 5, 6],
+            'data': [None, 5, 15, 50, 999],
+            'talk': [None, 99999],
+            'text': [None, 99999],
+            'sort': ['price'],
+            'limit': [20],
+        },
+        # Store the precomputed responses in datastore, so other instances load them instead of computing them.
+        'RECOMMEND_PROFILES_PERSIST': environ.get('RECOMMEND_PROFILES_PERSIST', 'true').lower() == 'true',
+        # Most operations accepted by POST /plans:batch in one request.
+        'PLANS_BATCH_MAX': 2000,
+        # Most catalog versions returned by one GET /plans/changes response.
+        'PLAN_CHANGES_MAX_VERSIONS': 100,
+        # Most plans accepted by POST /compare in one request.
+        'COMPARE_MAX_PLANS': 10,
+        # Token buckets per client IP: (requests per second, burst). Routes without an entry are not limited.
+        'RATE_LIMITS': {'auth': (1, 10), 'recommend': (5, 30), 'compare': (5, 30)},
+        # Redis URL to share the buckets between instances, e.g. Memorystore. Each worker keeps its own otherwise.
+        'RATE_LIMIT_REDIS_URL': environ.get('RATE_LIMIT_REDIS_URL'),
+        'RATE_LIMIT_REDIS_TIMEOUT': 0.2,
+        # Buckets kept in memory by each worker when redis isn't used.
+        'RATE_LIMIT_MEMORY_KEYS': 10000,
+        # Proxies that append to X-Forwarded-For after the client address. 1 for the App Engine load balancer.
+        'RATE_LIMIT_PROXY_HOPS': int(environ.get('RATE_LIMIT_PROXY_HOPS', 1)),
     }
     
     return CONFIG
\ No newline at end of file
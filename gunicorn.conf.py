@@ -0,0 +1,16 @@
+'''
+Gunicorn settings used by app.yaml. SERVING_MODE selects the worker:
+    asgi (default): uvicorn workers serving asgi:app. Requests waiting on datastore or Google don't block the worker.
+    wsgi: the previous synchronous workers serving main:app.
+'''
+from os import environ
+
+bind = ':' + environ.get('PORT', '8080')
+workers = int(environ.get('WEB_CONCURRENCY', 1))
+timeout = 60
+
+if environ.get('SERVING_MODE', 'asgi') == 'asgi':
+    wsgi_app = 'asgi:app'
+    worker_class = 'uvicorn_worker.UvicornWorker'
+else:
+    wsgi_app = 'main:app'
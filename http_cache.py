@@ -0,0 +1,50 @@
+'''
+HTTP caching for the plan read routes. Plans only change through the admin write routes, which bump the catalog
+version, so the version identifies every representation of the catalog.
+Responses carry a strong ETag built from the version and the request, and a Cache-Control header so a CDN can
+serve repeat reads. A request whose If-None-Match matches gets a 304 before the view runs.
+The version itself is sent in the Catalog-Version header.
+Functions: conditional
+'''
+import hashlib
+from functools import wraps
+from flask import current_app, make_response, request
+import compression
+
+
+def _etag(version):
+    # Query string and Accept select different representations of the same catalog version.
+    variant = f'{version}|{request.path}|{request.query_string.decode()}|{request.headers.get("Accept", "")}'
+    return f'v{version}-' + hashlib.sha1(variant.encode()).hexdigest()[:16]
+
+
+def conditional(get_version):
+    '''
+    Decorator for GET routes whose response only depends on the catalog version and the request.
+    Arguments:
+        get_version: function returning the current catalog version
+    Returns:
+        function: decorator
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            version = get_version()
+            etag = _etag(version)
+            cache_control = current_app.config['PLANS_CACHE_CONTROL']
+            if request.if_none_match.contains_weak(etag):
+                response = make_response('', 304)
+            else:
+                # The ETag identifies the body, so its compressed copies can be reused.
+                compression.set_key(etag)
+                response = make_response(func(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            # Clients syncing with GET /plans/changes start from this version.
+            response.headers['Catalog-Version'] = str(version)
+            response.headers['Cache-Control'] = cache_control
+            response.vary.add('Accept')
+            return response
+        return wrapper
+    return decorator
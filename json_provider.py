@@ -0,0 +1,39 @@
+'''
+JSON provider for the app backed by orjson, registered in create_app.
+orjson serializes dicts (including datastore.Entity), lists and datetimes in C and writes bytes, so responses
+skip the str to bytes round trip of the default provider. Datetimes are sent as ISO 8601 strings.
+Keys are not sorted, unlike the default provider.
+Classes: OrjsonProvider
+'''
+import datetime
+import orjson
+from flask.json.provider import DefaultJSONProvider, _default
+
+OPTIONS = orjson.OPT_NON_STR_KEYS
+
+
+def _fallback(o):
+    # datastore returns DatetimeWithNanoseconds, a datetime subclass orjson doesn't handle natively.
+    if isinstance(o, (datetime.datetime, datetime.date)):
+        return o.isoformat()
+    return _default(o)
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    '''
+    Flask JSON provider using orjson. Used for jsonify, views returning dicts and lists, and request.get_json.
+    Arguments:
+        app: Flask
+    '''
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=_fallback, option=OPTIONS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        options = OPTIONS | orjson.OPT_APPEND_NEWLINE
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            options |= orjson.OPT_INDENT_2
+        return self._app.response_class(orjson.dumps(obj, default=_fallback, option=options), mimetype=self.mimetype)
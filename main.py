@@ -1,16 +1,20 @@
 '''
 API for Cellular Savior. This file only contains the API routes.
-Functions/ROUTES: home, index, auth_initiate, oauth_callback, get_user, get_public_key, get_plans, recommend, get_plan, create_plan, delete_plan, patch_plan
+Functions/ROUTES: home, index, warmup, auth_initiate, oauth_callback, get_user, get_public_key, get_plans, get_plan_changes, recommend, get_plan, compare_plans, create_plan, delete_plan, patch_plan,
+                  batch_plans, export_plans, cache_stats, get_metrics, cleanup_states, refresh_profiles,
+                  cleanup_states_command
 Exceptions: ERROR_400, ERROR_401, ERROR_403, ERROR_404
 '''
 
+from urllib.parse import urlencode
 from flask import request, jsonify
 from __init__ import create_app
+from google.auth import exceptions as google_auth_exceptions
 from google.cloud import datastore
-from google.auth.transport import requests as google_requests
-from google.oauth2 import id_token as google_id_token
 from security import auth_decorators
-import requests, utils
+from security import google_oauth
+from security import state as oauth_state
+import requests, utils, clients, comparison, compression, http_cache, metrics, parallel, plan_batch, plan_cache, pricing, rate_limit, recommender, recommend_cache, recommend_profiles, serialization
 
 
 app = create_app()
@@ -27,7 +31,19 @@ ERROR_404 = {"Error": "Not found"}
 
 SELF_URL = 'https://api.cellularsavior.com/'
 
-client = datastore.Client()
+# Shared with every module and created on first use, see clients.py.
+client = clients.LazyClient()
+# Per worker copy of the plans kind. Plan reads are served from here instead of datastore.
+catalog = plan_cache.PlanCatalog(client, ttl=app.config['PLAN_CACHE_TTL'],
+                                 document=lambda plan: serialization.plan_document(plan, SELF_URL),
+                                 max_age=app.config['PLAN_CACHE_MAX_AGE'])
+# Responses of POST /recommend for the current catalog version.
+recommend_results = recommend_cache.ResultCache(maxsize=app.config['RECOMMEND_CACHE_SIZE'])
+# /recommend computations running in this worker, shared by identical requests.
+recommend_inflight = recommend_cache.SingleFlight()
+# Precomputed /recommend responses for the common requests, rebuilt for each catalog version.
+profiles = recommend_profiles.ProfileStore(app.config['RECOMMEND_PROFILES'],
+                                           client=client if app.config['RECOMMEND_PROFILES_PERSIST'] else None)
 
 
 @app.route('/', methods=['GET'])
@@ -38,22 +54,38 @@ def index():
     return 'API Documentation will be here. /api/auth/key for public key.', 200
 
 
+@app.route('/_ah/warmup', methods=['GET'])
+def warmup():
+    '''
+    Warmup route called by App Engine before an instance gets traffic (inbound_services: warmup in app.yaml).
+    Loads what the first requests would otherwise wait for: the datastore client, the plan catalog and the
+    recommendation engine, and Google's certs over the pooled HTTP session. The keys are parsed in create_app.
+    Returns:
+        str: empty
+    '''
+    catalog.derived('engine', recommender.RecommendationEngine)
+    _refresh_profiles()
+    try:
+        google_oauth.prefetch_certs()
+    except google_auth_exceptions.TransportError as e:
+        # Logins fetch the certs themselves, the instance can still serve.
+        print(f'Cert prefetch failed: {e}')
+    return '', 200
+
+
 # Authentication routes
 @app.route('/auth/initiate', methods=['GET'])
+@rate_limit.limit('auth')
 def auth_initiate():
     '''
     Returns the URL for the user to authenticate with Google. This url contains the client_id, redirect_uri, scope, and state.
     Client is responsible for the redirection to the URL.
-    State is a random string that is used to prevent CSRF attacks.
+    State is a signed, timestamped random string that is used to prevent CSRF attacks.
     Returns:
         dict: url, state
     '''
-    state = utils.generate_state()
-    # Store state in datastore with an expiration date. Check state in callback route.
-    entity = datastore.Entity(client.key('state'))
-    entity['state'] = state
-    entity['expiration'] = utils.get_expiration()
-    client.put(entity)
+    # The state carries its own signature and timestamp, so nothing is stored. Checked in the callback route.
+    state = oauth_state.issue_state()
 
     url = (
         "https://accounts.google.com/o/oauth2/v2/auth"
@@ -63,6 +95,7 @@ def auth_initiate():
     return jsonify({"url": url, 'state': state}), 200
 
 @app.route('/auth/callback', methods=['POST'])
+@rate_limit.limit('auth')
 def oauth_callback():
     '''
     Callback route for OAuth2.0. This route exchanges the code for tokens and verifies the ID token.
@@ -77,31 +110,25 @@ def oauth_callback():
         return ERROR_400, 400
 
     # Verify state to prevent CSRF attacks
-    # Check if state exists in datastore and is not expired
-    query = client.query(kind='state')
-    query.add_filter(filter=datastore.query.PropertyFilter('state', '=', state))
-    results = list(query.fetch())
-    if not results:
-        print('State not found')
-        return ERROR_403, 403
-    elif not utils.get_expiration(results[0]['expiration']):
-        print('State expired')
-        # Delete the state from the datastore
-        client.delete(results[0].key)
+    # Check the signature, that the state is not expired and that it wasn't used before
+    rejected = oauth_state.verify_state(state)
+    if rejected:
+        print(f'State {rejected}')
         return ERROR_403, 403
 
     # Exchange code for tokens
-    url = "https://oauth2.googleapis.com/token"
-    headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    data = {
-        "code": code,
-        "client_id": GOOGLE_AUTH_CLIENT_ID,
-        "client_secret": GOOGLE_AUTH_CLIENT_SECRET,
-        "redirect_uri": GOOGLE_AUTH_REDIRECT_URI,
-        "grant_type": "authorization_code"
-    }
-    response = requests.post(url, headers=headers, data=data)
-    tokens = response.json()
+    # Pooled connection with a timeout, a slow token endpoint fails the login instead of holding the worker
+    # Missing or expired certs are refreshed at the same time, so verifying the ID token doesn't wait on a second
+    # round trip. Cached certs need no request and no worker thread.
+    certs = None if google_oauth.certs_cached() else parallel.submit(google_oauth.prefetch_certs)
+    try:
+        tokens = google_oauth.exchange_code(code)
+    except (requests.RequestException, ValueError) as e:
+        print(f'Token exchange failed: {e}')
+        return ERROR_400, 400
+    # A failed refresh is retried by the verification below
+    if certs and certs.exception():
+        print(f'Cert prefetch failed: {certs.exception()}')
 
     # id_token is the JWT that can be used to authenticate the user
     id_token = tokens.get("id_token")
@@ -111,9 +138,7 @@ def oauth_callback():
 
     # Verify the ID token
     try:
-        id_info = google_id_token.verify_oauth2_token(
-            id_token, google_requests.Request(), GOOGLE_AUTH_CLIENT_ID
-        )
+        id_info = google_oauth.verify_id_token(id_token)
     except ValueError:
         return jsonify({"error": "Invalid ID token"}), 400
 
@@ -154,101 +179,341 @@ def verify_jwt():
 
 # User routes
 @app.route('/plans', methods=['GET'])
+@http_cache.conditional(catalog.latest_version)
 def get_plans():
     '''
     Get all the plans from the database.
     Client should use this router to get all the plans.
+    Send Accept: application/x-ndjson to have the plans streamed one per line.
+    Responses have an ETag from the catalog version. Send it back in If-None-Match to get a 304 if nothing changed.
+    Query Parameters:
+            fields: str (optional) comma separated plan properties to return, id and self are always included
+            limit: int (optional) page size, at most PLANS_MAX_LIMIT
+            cursor: str (optional) next_cursor from the previous page
+    Sending limit or cursor pages through the database instead of returning every plan. next_cursor and the next
+    link are only set when there may be another page. With NDJSON they are sent in the Next-Cursor and Link headers.
     Returns:
         list: plans
+        dict: results (list of plans), next_cursor, next (when paging)
+    '''
+    fields = serialization.requested_fields()
+    if 'limit' in request.args or 'cursor' in request.args:
+        return _plans_page(fields)
+    # JSON and NDJSON are both served from the cached plans, which are reloaded once when they are stale.
+    # Fields are trimmed from the cached plans. A projection query would skip plans missing a projected property,
+    # so the same URL and ETag would return fewer plans while the cache is cold.
+    # Cached plans already have their id and self link. They are shared, so select_fields builds new dicts.
+    results = (serialization.select_fields(plan, fields) for plan in catalog.plans())
+    if serialization.wants_ndjson():
+        return serialization.ndjson_response(results)
+    return list(results), 200
+
+def _plans_page(fields):
+    '''
+    One page of GET /plans, read with a datastore cursor so only the page is loaded.
     '''
+    try:
+        limit = int(request.args.get('limit', app.config['PLANS_DEFAULT_LIMIT']))
+    except ValueError:
+        return ERROR_400, 400
+    if not 0 < limit <= app.config['PLANS_MAX_LIMIT']:
+        return ERROR_400, 400
+
+    # Full entities, not a projection: projections skip plans missing a projected property.
     query = client.query(kind='plans')
-    results = list(query.fetch())
-    # We only add the id if the user is an admin
-    for i in results:
-        i['id'] = i.id
-        i['self'] = f'{SELF_URL}plans/{i.id}'
+    try:
+        entities, next_cursor = serialization.fetch_page(query, limit, request.args.get('cursor') or None)
+    except ValueError:
+        return ERROR_400, 400
 
-    return results, 200
+    results = [serialization.select_fields(serialization.plan_document(plan, SELF_URL), fields) for plan in entities]
+    response = {'results': results}
+    if next_cursor:
+        response['next_cursor'] = next_cursor
+        response['next'] = SELF_URL + 'plans?' + urlencode(dict(request.args, limit=limit, cursor=next_cursor))
+    if serialization.wants_ndjson():
+        headers = {'Next-Cursor': next_cursor, 'Link': f'<{response["next"]}>; rel="next"'} if next_cursor else None
+        return serialization.ndjson_response(results, headers=headers)
+    return response, 200
+
+@app.route('/plans/changes', methods=['GET'])
+@http_cache.conditional(catalog.latest_version)
+def get_plan_changes():
+    '''
+    Get the plans created, patched or deleted after a catalog version, so clients can update their copy of the
+    plans instead of downloading all of them again.
+    Changes are merged per plan: each plan is listed once with its last operation and its current document.
+    Query Parameters:
+            since: int (required) version from the previous response, 0 for every change
+            fields: str (optional) comma separated plan properties to return, see get_plans
+    Returns:
+        dict: version (send it as since next time), changes (list of {id, op, version, plan}),
+              more (true if there are more changes after version)
+        410 with the current version if the changes since that version aren't kept. Get every plan from GET /plans
+        and continue from its Catalog-Version header.
+    The first sync starts from the Catalog-Version header of GET /plans.
+    '''
+    try:
+        since = int(request.args['since'])
+    except (KeyError, ValueError):
+        return ERROR_400, 400
+    if since < 0:
+        return ERROR_400, 400
+    limit = app.config['PLAN_CHANGES_MAX_VERSIONS']
+    records = catalog.changes_since(since, limit=limit)
+    if records is None:
+        latest = catalog.latest_version()
+        if since != latest:
+            return {"Error": "Changes since this version are not available", "version": latest}, 410
+        records = []
+
+    last = {}
+    for record in records:
+        for plan_id, op in record['changes']:
+            last[plan_id] = (op, record['version'])
+    ids = [plan_id for plan_id, (op, _) in last.items() if op != 'delete']
+    found = {}
+    for start in range(0, len(ids), plan_batch.LOOKUP_CHUNK):
+        keys = [client.key('plans', plan_id) for plan_id in ids[start:start + plan_batch.LOOKUP_CHUNK]]
+        for entity in client.get_multi(keys):
+            found[entity.key.id] = entity
+
+    fields = serialization.requested_fields()
+    changes = []
+    for plan_id, (op, version) in last.items():
+        plan = found.get(plan_id)
+        if plan is None:
+            # Deleted by a later change than the ones in this response.
+            changes.append({'id': plan_id, 'op': 'delete', 'version': version})
+        else:
+            document = serialization.select_fields(serialization.plan_document(plan, SELF_URL), fields)
+            changes.append({'id': plan_id, 'op': op, 'version': version, 'plan': document})
+    return {
+        'version': records[-1]['version'] if records else since,
+        'changes': changes,
+        'more': len(records) == limit,
+    }, 200
 
 @app.route('/recommend', methods=['POST'])
+@rate_limit.limit('recommend')
 def recommend():
     '''
     Get a plan recommendation.
     This function will return a list of plans that match or beat: data, hotspot, talk, and text.
     The list will filter out plans that are not provided by the carriers in the carriers list.
+    Plans are ordered by their monthly price for the requested number of lines, cheapest first,
+    or by a score of price per line, surplus data/hotspot and carrier preference when sort is 'score'.
+    A body with only lines returns every plan in catalog order, not filtered by line count or sorted, unless
+    limit or cursor is given.
     Request Body:
                 lines: int (required)   
                 data: int (optional)
                 hotspot: int (optional)
                 talk: int (optional)
                 text: int (optional)
-                price: float (optional)
-                financing_status: bool (optional)
+                price: float (optional) highest monthly price for all lines
+                financing_status: bool (optional) if true, only plans that pay off device financing
                 carriers: list (optional)
+                sort: str (optional) 'price' (default) or 'score'
+                preferred_carriers: list (optional) most preferred first, used by the score
+    Query Parameters:
+                limit: int (optional) page size, at most RECOMMEND_MAX_LIMIT
+                cursor: str (optional) next_cursor from the previous page
+
+    Send Accept: application/x-ndjson to have the plans streamed one per line. next_cursor is then sent in the
+    Next-Cursor header.
+    The fields query parameter selects plan properties, see get_plans.
 
     Returns:
-        list: plans
+        dict: results (list of plans), next_cursor (only when limit is set and there are more plans)
     '''
     data = request.get_json()
     if not data or 'lines' not in data:
         return ERROR_400, 400
+    try:
+        lines = int(data['lines'])
+    except (TypeError, ValueError):
+        return ERROR_400, 400
     provided_fields = []
 
     # Get all provided fields. If only lines is provided, return all plans
     for field in data:
         provided_fields.append(field)
+    paged = 'limit' in request.args or 'cursor' in request.args
     # If only lines is provided, return all plans
-    if len(provided_fields) == 1:
-        query = client.query(kind='plans')
-        results = list(query.fetch())
-        return {'results': results}, 200
-    
-    query = client.query(kind='plans')
-    if 'data' in provided_fields:
-        query.add_filter('data', '>=', int(data['data']))
-
-    if 'hotspot' in provided_fields:
-        query.add_filter('hotspot', '>=', int(data['hotspot']))
-
-    if 'talk' in provided_fields:
-        query.add_filter('talk', '>=', int(data['talk']))
-
-    if 'text' in provided_fields:
-        query.add_filter('text', '>=', int(data['text']))
-    results = list(query.fetch())
-
-    # Filter out plans that are not provided by the carriers in the carriers list.
-    if 'carriers' in provided_fields:
-        for i in results:
-            if i['carrier'] not in data['carriers']:
-                results.remove(i)
+    if len(provided_fields) == 1 and not paged:
+        # Same body for every number of lines, so one compressed copy per catalog version is reused.
+        compression.set_key(('recommend', catalog.version(), request.query_string))
+        return _recommend_response({'results': catalog.plans()})
 
-    # Filter plans that don't have the desired line number. 
-    # This need to be done after the DB query because of the way we stored price.
-    results = [plan for plan in results if str(data['lines']) in plan['price']]
+    try:
+        minimums = {field: int(data[field]) for field in recommender.ALLOWANCE_FIELDS if field in provided_fields}
+        max_price = float(data['price']) if data.get('price') is not None else None
+        limit = int(request.args['limit']) if 'limit' in request.args else None
+    except (TypeError, ValueError):
+        return ERROR_400, 400
+    order = data.get('sort', 'price')
+    if order not in ('price', 'score'):
+        return ERROR_400, 400
+    for field in ['carriers', 'preferred_carriers']:
+        value = data.get(field)
+        if value is not None and (not isinstance(value, list) or not all(isinstance(i, str) for i in value)):
+            return ERROR_400, 400
+    if paged and limit is None:
+        limit = app.config['RECOMMEND_DEFAULT_LIMIT']
+    if limit is not None and not 0 < limit <= app.config['RECOMMEND_MAX_LIMIT']:
+        return ERROR_400, 400
+    offset = 0
+    if 'cursor' in request.args:
+        cursor = utils.decode_cursor(request.args['cursor'])
+        if cursor == 0:
+            return ERROR_400, 400
+        offset = cursor['offset']
+
+    # One extra plan tells us whether there is another page.
+    params = {
+        'lines': lines,
+        'carriers': data.get('carriers'),
+        'minimums': minimums,
+        'max_price': max_price,
+        'payoff': bool(data.get('financing_status')),
+        'order': order,
+        'limit': None if limit is None else limit + 1,
+        'offset': offset,
+        'preferred_carriers': data.get('preferred_carriers'),
+    }
+    # Equivalent requests share one cached response per catalog version.
+    # Read the version before the engine so a response is never labelled with a newer version than its data.
+    version = catalog.version()
+    key = recommend_cache.normalize_request(params)
+    compression.set_key(('recommend', version, key, request.query_string))
+    # Common requests are answered with their precomputed response, already serialized.
+    if serialization.requested_fields() is None and not serialization.wants_ndjson():
+        blob = profiles.get(version, key)
+        if blob is not None:
+            return app.response_class(blob, mimetype='application/json')
+    if profiles.behind(version):
+        parallel.submit(_refresh_profiles)
+    response = recommend_results.get(version, key)
+    if response is not None:
+        return _recommend_response(response)
+
+    def compute():
+        # The engine applies the allowance, carrier and line filters with in-memory indexes.
+        # It is rebuilt once each time the catalog is reloaded.
+        with metrics.timer('catalog'):
+            engine = catalog.derived('engine', recommender.RecommendationEngine)
+        with metrics.timer('engine'):
+            response = recommend_profiles.build_response(engine, params)
+        recommend_results.set(version, key, response)
+        return response
+
+    # Identical requests arriving together, e.g. right after a catalog reload, share one computation.
+    return _recommend_response(recommend_inflight.do((version, key), compute))
+
+def _recommend_response(response):
+    '''
+    Send a recommend response as JSON, or as NDJSON if the client asked for it.
+    Cached responses are shared, so selecting fields builds new plans.
+    '''
+    fields = serialization.requested_fields()
+    results = response['results']
+    if fields is not None:
+        results = [serialization.select_fields(plan, fields) for plan in results]
+    if serialization.wants_ndjson():
+        headers = {'Next-Cursor': response['next_cursor']} if 'next_cursor' in response else None
+        return serialization.ndjson_response(results, headers=headers)
+    if fields is not None:
+        response = dict(response, results=results)
+    return response, 200
+
+def _refresh_profiles():
+    '''
+    Build the precomputed /recommend responses for the current catalog version, unless they are already built.
+    '''
+    # Read the version before the engine, like the recommend route.
+    version = catalog.version()
+    if profiles.refresh(version, lambda: catalog.derived('engine', recommender.RecommendationEngine)):
+        stats = profiles.stats()
+        print(f"Recommend profiles for version {version}: {stats['profiles']} {stats['source']} in {stats['seconds']}s")
 
-    for i in results:
-        i['id'] = i.id
-        i['self'] = f'{SELF_URL}plans/{i.id}'
-    return {'results': results}, 200
+def _record_write(changes):
+    '''
+    Bump the catalog version after a plan write and rebuild the precomputed /recommend responses in the background.
+    Arguments:
+        changes: list of (plan_id, operation)
+    '''
+    catalog.bump_version(changes)
+    parallel.submit(_refresh_profiles)
 
 @app.route('/plans/<plan_id>', methods=['GET'])
+@http_cache.conditional(catalog.latest_version)
 def get_plan(plan_id):
     '''
     Get a plan by ID.
     Arguments:
         plan_id: int
+    Query Parameters:
+        fields: str (optional) comma separated plan properties to return
     Returns:
         plan
     '''
     if not plan_id:
         return ERROR_400, 400
-    key = client.key('plans', int(plan_id))
-    plan = client.get(key)
+    plan = catalog.get(int(plan_id))
     if not plan:
         return ERROR_404, 404
     
-    return plan, 200
+    return serialization.select_fields(plan, serialization.requested_fields()), 200
+
+
+@app.route('/compare', methods=['POST'])
+@rate_limit.limit('compare')
+def compare_plans():
+    '''
+    Compare plans side by side.
+    Prices, price per line and price differences to the baseline plan are computed for every number of lines any
+    of the plans has a price for, along with the cheapest plan per number of lines and allowance differences.
+    Request Body:
+                ids: list (required) plan IDs, at most COMPARE_MAX_PLANS
+                baseline: int (optional) plan ID to compare against, defaults to the first ID
+                lines: int (optional) only compare this number of lines
+    Returns:
+        dict: baseline, lines, cheapest, comparison (one per plan) and plans (the plan documents)
+    '''
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('ids'), list) or not data['ids']:
+        return ERROR_400, 400
+    try:
+        # Duplicates are dropped, the order of the first occurrence is kept.
+        ids = list(dict.fromkeys(int(plan_id) for plan_id in data['ids']))
+        baseline = int(data.get('baseline', ids[0]))
+        lines = int(data['lines']) if data.get('lines') is not None else None
+    except (TypeError, ValueError):
+        return ERROR_400, 400
+    if len(ids) > app.config['COMPARE_MAX_PLANS'] or baseline not in ids or (lines is not None and lines < 1):
+        return ERROR_400, 400
+
+    plans = {plan_id: catalog.get(plan_id) for plan_id in ids}
+    misses = [plan_id for plan_id, plan in plans.items() if plan is None]
+    if misses:
+        # Plans written since the catalog was loaded. One lookup for all of them.
+        for entity in client.get_multi([client.key('plans', plan_id) for plan_id in misses]):
+            plans[entity.key.id] = serialization.plan_document(entity, SELF_URL)
+    missing = [plan_id for plan_id, plan in plans.items() if plan is None]
+    if missing:
+        return {**ERROR_404, 'missing': missing}, 404
+
+    ordered = [plans[plan_id] for plan_id in ids]
+    result = comparison.compare(ordered, baseline=ids.index(baseline), lines=lines)
+    fields = serialization.requested_fields()
+    return {
+        'baseline': result['baseline'],
+        'lines': result['lines'],
+        'cheapest': result['cheapest'],
+        'comparison': result['plans'],
+        'plans': [serialization.select_fields(plan, fields) for plan in ordered],
+    }, 200
 
 
 # Admin only routes.
@@ -265,6 +530,7 @@ def create_plan():
             talk: int (required)
             text: int (required)
             price: dict {lines: string, amount: string} (required)
+                The numeric price_table used by recommendations is built from price.
             carrier: str (required)
             networks: list (required)
             description: str (required)
@@ -283,11 +549,17 @@ def create_plan():
     if results:
         return {"Error": "A plan with that name already exists"}, 400
     # Later verify the data
+    # Parse the price once here so recommendations can compare numbers.
+    price_table = pricing.build_price_table(data.get('price'))
+    if price_table == 0:
+        return {"Error": "The price is invalid"}, 400
+    data['price_table'] = price_table
     new_plan = datastore.Entity(client.key('plans'))
     # Add date added to the plan
-    data['date_added'] = utils.get_date_time()
+    data['date_added'] = data['date_modified'] = utils.get_date_time()
     new_plan.update(data)
     client.put(new_plan)
+    _record_write([(new_plan.id, 'create')])
     new_plan['id'] = new_plan.id
     new_plan['self'] = f'{SELF_URL}plans/{new_plan['id']}'
     print(new_plan)
@@ -305,7 +577,8 @@ def delete_plan(plan_id):
     plan = client.get(key)
     if not plan:
         return ERROR_404, 404
-    client.delete(plan)
+    client.delete(key)
+    _record_write([(key.id, 'delete')])
     return '', 204
 
 @app.route('/plans/<plan_id>', methods=['PATCH'])
@@ -323,13 +596,130 @@ def patch_plan(plan_id):
     plan = client.get(key)
     if not plan:
         return ERROR_404, 404
+    # Keep the parsed price table in sync with price. It can't be patched directly.
+    data.pop('price_table', None)
+    if 'price' in data:
+        price_table = pricing.build_price_table(data['price'])
+        if price_table == 0:
+            return {"Error": "The price is invalid"}, 400
+        data['price_table'] = price_table
     for field in data:
         plan[field] = data[field]
+    plan['date_modified'] = utils.get_date_time()
     client.put(plan)
+    _record_write([(plan.id, 'patch')])
     plan['id'] = plan.id
     plan['self'] = f'{SELF_URL}plans/{plan['id']}'
     return plan, 200
 
+@app.route('/plans:batch', methods=['POST'])
+@auth_decorators.admin_required
+def batch_plans():
+    '''
+    Create, patch and delete many plans in one request.
+    Every item is validated before anything is written and gets its own result.
+    Request Body: JSON array or NDJSON (Content-Type: application/x-ndjson) of operations
+            {"op": "create", "plan": plan}
+            {"op": "patch", "id": int, "plan": fields to change}
+            {"op": "delete", "id": int}
+    Returns:
+        dict: results, list of {index, status, id, error}
+    '''
+    items = plan_batch.parse_items(request.get_data(), request.content_type)
+    if not items:
+        return ERROR_400, 400
+    if len(items) > app.config['PLANS_BATCH_MAX']:
+        return {"Error": f"A batch can have at most {app.config['PLANS_BATCH_MAX']} items"}, 400
+    results, written = plan_batch.run_batch(client, items)
+    if written:
+        _record_write(plan_batch.changes(items, results))
+    return {"results": results}, 200
+
+@app.route('/plans:export', methods=['GET'])
+@auth_decorators.admin_required
+def export_plans():
+    '''
+    Export every plan, read directly from the database, as NDJSON (one plan per line, with its id).
+    Returns:
+        NDJSON: plans
+    '''
+    plans = serialization.iter_query(client.query(kind='plans'))
+    return serialization.ndjson_response(dict(plan, id=plan.id) for plan in plans)
+
+@app.route('/cache/stats', methods=['GET'])
+@auth_decorators.admin_required
+def cache_stats():
+    '''
+    Get the hit and miss counters of the in-memory caches of this worker.
+    Returns:
+        dict: recommend, profiles, compression
+    '''
+    recommend = dict(recommend_results.stats(), coalesced=recommend_inflight.coalesced)
+    return {"recommend": recommend, "profiles": profiles.stats(), "compression": compression.stats()}, 200
+
+
+@app.route('/metrics', methods=['GET'])
+@auth_decorators.metrics_required
+def get_metrics():
+    '''
+    Get the request, datastore and outbound HTTP metrics of this worker in the Prometheus text format.
+    Send the METRICS_TOKEN as a bearer token, or an admin JWT if METRICS_TOKEN is not set.
+    Returns:
+        text: metrics
+    '''
+    stats = recommend_results.stats()
+    compressed = compression.stats()
+    return metrics.exposition({
+        'recommend_cache_hits_total': stats['hits'],
+        'recommend_cache_misses_total': stats['misses'],
+        'recommend_cache_invalidations_total': stats['invalidations'],
+        'recommend_cache_size': stats['size'],
+        'compression_cache_hits_total': compressed['hits'],
+        'compression_cache_misses_total': compressed['misses'],
+        'plan_catalog_version': catalog.latest_version(),
+    })
+
+
+# Scheduled tasks
+@app.route('/tasks/cleanup-states', methods=['GET'])
+@auth_decorators.cron_required
+def cleanup_states():
+    '''
+    Delete expired OAuth states. Called by App Engine cron, see cron.yaml.
+    States are no longer stored by auth_initiate, this removes the ones left from earlier logins.
+    Returns:
+        dict: deleted, batches, seconds, finished
+    '''
+    report = utils.delete_expired_states(
+        batch_size=app.config['STATE_GC_BATCH_SIZE'], pause=app.config['STATE_GC_PAUSE'],
+        max_seconds=app.config['STATE_GC_MAX_SECONDS']
+    )
+    print(f"Deleted {report['deleted']} expired states in {report['seconds']}s")
+    return report, 200
+
+@app.route('/tasks/recommend-profiles', methods=['GET'])
+@auth_decorators.cron_required
+def refresh_profiles():
+    '''
+    Build the precomputed /recommend responses for the current catalog version. Called by App Engine cron, see
+    cron.yaml. Plan writes already rebuild them, this covers instances that missed a write.
+    Returns:
+        dict: profiles, version, hits, bytes, seconds, source
+    '''
+    _refresh_profiles()
+    return profiles.stats(), 200
+
+@app.cli.command('cleanup-states')
+def cleanup_states_command():
+    '''
+    Delete expired OAuth states from the command line: flask --app main cleanup-states
+    '''
+    report = utils.delete_expired_states(
+        batch_size=app.config['STATE_GC_BATCH_SIZE'], pause=app.config['STATE_GC_PAUSE'],
+        max_seconds=float('inf')
+    )
+    print(f"Deleted {report['deleted']} expired states in {report['batches']} batches, {report['seconds']}s")
+
 
 if __name__ == '__main__':
     app.run(host='127.0.0.1', port=8080, debug=True)
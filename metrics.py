@@ -0,0 +1,290 @@
+'''
+Request metrics for the API, hooked into the app by create_app.
+Every request is timed per route, with its response size. Datastore RPCs are counted and timed by wrapping the
+shared clients with InstrumentedClient. Outbound HTTP calls are timed by a requests response hook.
+Time spent in datastore, outbound HTTP, named phases (timer) and response serialization is added up per request
+and sent in the Server-Timing header when SERVER_TIMING is set, e.g. Server-Timing: datastore;dur=12.1;desc="3 rpcs", engine;dur=0.8, ...
+The counters of this worker are exposed in the Prometheus text format by the /metrics route.
+Classes: InstrumentedClient
+Functions: init_app, timer, record_http, exposition
+'''
+import bisect, threading, time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+from flask import Response, g, has_app_context, request
+
+# Upper bounds in seconds for latency histograms and in bytes for response sizes.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+PROMETHEUS = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Datastore client methods that make one RPC per call.
+RPC_METHODS = ('get', 'get_multi', 'put', 'put_multi', 'delete', 'delete_multi', 'allocate_ids', 'reserve_ids')
+
+
+class _Histogram:
+    '''
+    Prometheus histogram with labels. Thread safe.
+    '''
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def lines(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        with self._lock:
+            series = [(key, list(counts), total) for key, (counts, total) in self._series.items()]
+        for key, counts, total in sorted(series):
+            labels = ','.join(f'{name}="{_escape(value)}"' for name, value in key)
+            prefix = f'{labels},' if labels else ''
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}'
+            cumulative += counts[-1]
+            yield f'{self.name}_bucket{{{prefix}le="+Inf"}} {cumulative}'
+            suffix = f'{{{labels}}}' if labels else ''
+            yield f'{self.name}_sum{suffix} {total:.6f}'
+            yield f'{self.name}_count{suffix} {cumulative}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REQUEST_SECONDS = _Histogram('http_request_duration_seconds', 'Time to produce the response headers.',
+                             LATENCY_BUCKETS)
+RESPONSE_BYTES = _Histogram('http_response_size_bytes', 'Response body size.', SIZE_BUCKETS)
+DATASTORE_SECONDS = _Histogram('datastore_rpc_duration_seconds', 'Datastore RPC duration by client method.',
+                               LATENCY_BUCKETS)
+OUTBOUND_SECONDS = _Histogram('outbound_http_duration_seconds', 'Outbound HTTP call duration by host.',
+                              LATENCY_BUCKETS)
+HISTOGRAMS = (REQUEST_SECONDS, RESPONSE_BYTES, DATASTORE_SECONDS, OUTBOUND_SECONDS)
+
+
+def _add_timing(name, seconds):
+    # Phases outside a request (startup, background threads without a request) only go to the histograms.
+    if not has_app_context():
+        return
+    timings = g.setdefault('server_timings', {})
+    total, count = timings.get(name, (0.0, 0))
+    timings[name] = (total + seconds, count + 1)
+
+
+@contextmanager
+def timer(name):
+    '''
+    Time a phase of the current request for the Server-Timing header.
+    Arguments:
+        name: str, e.g. 'engine'
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _add_timing(name, time.perf_counter() - start)
+
+
+def _rpc(method, seconds):
+    DATASTORE_SECONDS.observe({'method': method}, seconds)
+    _add_timing('datastore', seconds)
+
+
+def record_http(response, *args, **kwargs):
+    '''
+    requests response hook that records the duration of an outbound call.
+    Usage: session.hooks['response'].append(metrics.record_http)
+    '''
+    seconds = response.elapsed.total_seconds()
+    OUTBOUND_SECONDS.observe({'host': urlsplit(response.url).netloc, 'status': response.status_code}, seconds)
+    _add_timing('http', seconds)
+
+
+class _InstrumentedIterator:
+    '''
+    Query iterator that times the RPCs made while its pages are read.
+    '''
+    def __init__(self, iterator):
+        self._iterator = iterator
+
+    def __getattr__(self, name):
+        return getattr(self._iterator, name)
+
+    @property
+    def pages(self):
+        pages = self._iterator.pages
+        while True:
+            start = time.perf_counter()
+            try:
+                page = next(pages)
+            except StopIteration:
+                # Raised without an RPC once the previous page said there are no more results.
+                return
+            except Exception:
+                _rpc('run_query', time.perf_counter() - start)
+                raise
+            _rpc('run_query', time.perf_counter() - start)
+            yield page
+
+    def __iter__(self):
+        for page in self.pages:
+            yield from page
+
+
+class _InstrumentedQuery:
+    def __init__(self, query):
+        self._query = query
+
+    def __getattr__(self, name):
+        return getattr(self._query, name)
+
+    def __setattr__(self, name, value):
+        if name == '_query':
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._query, name, value)
+
+    def fetch(self, *args, **kwargs):
+        return _InstrumentedIterator(self._query.fetch(*args, **kwargs))
+
+
+class _InstrumentedTransaction:
+    '''
+    Times the begin and commit RPCs of a transaction used as a context manager.
+    '''
+    def __init__(self, transaction):
+        self._transaction = transaction
+
+    def __getattr__(self, name):
+        return getattr(self._transaction, name)
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self._transaction.__enter__()
+        _rpc('begin_transaction', time.perf_counter() - start)
+        return self
+
+    def __exit__(self, *exc):
+        start = time.perf_counter()
+        try:
+            return self._transaction.__exit__(*exc)
+        finally:
+            _rpc('commit', time.perf_counter() - start)
+
+
+class InstrumentedClient:
+    '''
+    Wraps a datastore.Client and records the count and duration of its RPCs. Every other attribute is passed through.
+    Arguments:
+        client: datastore.Client
+    '''
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if name not in RPC_METHODS:
+            return attribute
+
+        def call(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                _rpc(name, time.perf_counter() - start)
+        return call
+
+    def query(self, *args, **kwargs):
+        return _InstrumentedQuery(self._client.query(*args, **kwargs))
+
+    def transaction(self, *args, **kwargs):
+        return _InstrumentedTransaction(self._client.transaction(*args, **kwargs))
+
+
+def _server_timing(total):
+    parts = [f'total;dur={total * 1000:.1f}']
+    for name, (seconds, count) in g.get('server_timings', {}).items():
+        part = f'{name};dur={seconds * 1000:.1f}'
+        if name == 'datastore':
+            part += f';desc="{count} rpcs"'
+        parts.append(part)
+    return ', '.join(parts)
+
+
+def _count_bytes(body, labels):
+    size = 0
+    try:
+        for chunk in body:
+            size += len(chunk)
+            yield chunk
+    finally:
+        RESPONSE_BYTES.observe(labels, size)
+
+
+def init_app(app):
+    '''
+    Time every request of the app and add the Server-Timing header if SERVER_TIMING is True.
+    Arguments:
+        app: Flask
+    '''
+    make_response = app.make_response
+
+    def timed_make_response(rv):
+        # Views return dicts and lists, which are serialized to JSON here.
+        with timer('serialize'):
+            return make_response(rv)
+
+    app.make_response = timed_make_response
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = g.get('request_start')
+        if start is None:
+            return response
+        total = time.perf_counter() - start
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        labels = {'route': route, 'method': request.method}
+        REQUEST_SECONDS.observe(dict(labels, status=response.status_code), total)
+        if response.is_streamed:
+            # Streamed bodies are produced after this hook, so they are measured while they are sent.
+            response.response = _count_bytes(response.response, labels)
+        else:
+            RESPONSE_BYTES.observe(labels, response.content_length or 0)
+        if app.config.get('SERVER_TIMING', False):
+            response.headers['Server-Timing'] = _server_timing(total)
+        return response
+
+
+def exposition(values=None):
+    '''
+    Render the metrics of this worker in the Prometheus text format.
+    Arguments:
+        values: dict (optional), extra untyped metrics by name, e.g. cache counters
+    Returns:
+        flask.Response
+    '''
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.lines())
+    for name, value in (values or {}).items():
+        lines.append(f'# TYPE {name} untyped')
+        lines.append(f'{name} {value}')
+    return Response('\n'.join(lines) + '\n', content_type=PROMETHEUS)
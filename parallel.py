@@ -0,0 +1,41 @@
+'''
+Shared thread pool for running independent datastore and HTTP calls of one request at the same time.
+The datastore client and requests.Session release the GIL while waiting on the network, so a route that needs two
+independent calls waits for the slower one instead of their sum.
+Submitted functions run inside the app context of the request that submitted them.
+Functions: submit
+'''
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+
+_executor = None
+_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=current_app.config['IO_THREADS'],
+                                               thread_name_prefix='io')
+    return _executor
+
+
+def submit(func, *args, **kwargs):
+    '''
+    Run a function in the shared pool.
+    Arguments:
+        func: function
+        *args, **kwargs: passed to func
+    Returns:
+        concurrent.futures.Future
+    '''
+    app = current_app._get_current_object()
+
+    def run():
+        with app.app_context():
+            return func(*args, **kwargs)
+
+    return _get_executor().submit(run)
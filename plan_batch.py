@@ -0,0 +1,201 @@
+'''
+Bulk plan writes for the admin batch endpoint. A batch is a list of operations:
+    {"op": "create", "plan": {...}}
+    {"op": "patch", "id": int, "plan": {...}}
+    {"op": "delete", "id": int}
+Every operation is validated before anything is written. Duplicate names are checked with one projection query
+and existing plans are loaded with batched lookups. Writes use put_multi/delete_multi in chunks that fit in one
+datastore commit. Every operation gets its own result, so one bad item doesn't fail the whole batch.
+Functions: parse_items, run_batch, changes
+'''
+import json
+from google.api_core import exceptions as google_exceptions
+from google.cloud import datastore
+import pricing, utils
+
+# Datastore limits: entities per commit and keys per lookup.
+WRITE_CHUNK = 500
+LOOKUP_CHUNK = 1000
+
+REQUIRED_FIELDS = ('name', 'data', 'hotspot', 'talk', 'text', 'price', 'carrier', 'networks', 'description',
+                   'payoff', 'url')
+INT_FIELDS = ('data', 'hotspot', 'talk', 'text')
+STR_FIELDS = ('name', 'carrier', 'description', 'url')
+
+
+def parse_items(body, content_type):
+    '''
+    Parse a batch request body. NDJSON (one operation per line) or a JSON array are accepted.
+    Arguments:
+        body: bytes
+        content_type: str
+    Returns:
+        list: operations
+        0 if the body can't be parsed
+    '''
+    try:
+        text = body.decode('utf-8')
+        if 'ndjson' in (content_type or ''):
+            return [json.loads(line) for line in text.splitlines() if line.strip()]
+        items = json.loads(text)
+        return items if isinstance(items, list) else 0
+    except (UnicodeDecodeError, ValueError):
+        return 0
+
+
+def _validate_fields(plan, required):
+    if not isinstance(plan, dict) or not plan:
+        return 'plan must be a non-empty object'
+    if required:
+        missing = [field for field in REQUIRED_FIELDS if field not in plan]
+        if missing:
+            return f'missing fields: {", ".join(missing)}'
+    for field in INT_FIELDS:
+        if field in plan and (not isinstance(plan[field], int) or isinstance(plan[field], bool)):
+            return f'{field} must be an integer'
+    for field in STR_FIELDS:
+        if field in plan and not isinstance(plan[field], str):
+            return f'{field} must be a string'
+    if 'networks' in plan and (not isinstance(plan['networks'], list)
+                               or not all(isinstance(network, str) for network in plan['networks'])):
+        return 'networks must be a list of strings'
+    if 'payoff' in plan and not isinstance(plan['payoff'], bool):
+        return 'payoff must be a boolean'
+    if 'price' in plan and pricing.build_price_table(plan['price']) == 0:
+        return 'The price is invalid'
+    return None
+
+
+def _validate(items):
+    '''
+    Check every operation. Returns a result per item, None for the items that can be written.
+    '''
+    results = []
+    seen_ids = set()
+    for item in items:
+        if not isinstance(item, dict) or item.get('op') not in ('create', 'patch', 'delete'):
+            results.append({'status': 400, 'error': 'op must be create, patch or delete'})
+            continue
+        op = item['op']
+        if op != 'create':
+            plan_id = item.get('id')
+            if not isinstance(plan_id, int) or isinstance(plan_id, bool):
+                results.append({'status': 400, 'error': 'id must be an integer'})
+                continue
+            if plan_id in seen_ids:
+                results.append({'status': 400, 'error': 'plan appears more than once in the batch'})
+                continue
+            seen_ids.add(plan_id)
+        if op != 'delete':
+            error = _validate_fields(item.get('plan'), required=op == 'create')
+            if error:
+                results.append({'status': 400, 'error': error})
+                continue
+        results.append(None)
+    return results
+
+
+def _existing_names(client):
+    # A projection on one property is served by the built-in index, so this reads only the names.
+    query = client.query(kind='plans')
+    query.projection = ['name']
+    return {plan['name'] for plan in query.fetch()}
+
+
+def _get_multi(client, keys):
+    found = {}
+    for start in range(0, len(keys), LOOKUP_CHUNK):
+        for entity in client.get_multi(keys[start:start + LOOKUP_CHUNK]):
+            found[entity.key.id] = entity
+    return found
+
+
+def _write(client, writes, results, method):
+    '''
+    Write (index, entity or key, result) tuples in chunks. A failed chunk marks its items as failed.
+    '''
+    for start in range(0, len(writes), WRITE_CHUNK):
+        chunk = writes[start:start + WRITE_CHUNK]
+        try:
+            method([target for _, target, _ in chunk])
+        except google_exceptions.GoogleAPICallError as e:
+            for index, _, _ in chunk:
+                results[index] = {'status': 500, 'error': str(e)}
+            continue
+        for index, target, result in chunk:
+            if isinstance(target, datastore.Entity):
+                result['id'] = target.key.id
+            results[index] = result
+
+
+def run_batch(client, items):
+    '''
+    Validate and apply a list of plan operations.
+    Arguments:
+        client: datastore.Client
+        items: list of operations
+    Returns:
+        list: one result per operation, in order: {index, status, id, error}
+        int: number of plans written
+    '''
+    results = _validate(items)
+
+    # Duplicate names are checked against the stored plans and within the batch.
+    names = None
+    if any(result is None and item['op'] == 'create' for item, result in zip(items, results)):
+        names = _existing_names(client)
+    ids = [item['id'] for item, result in zip(items, results) if result is None and item['op'] != 'create']
+    existing = _get_multi(client, [client.key('plans', plan_id) for plan_id in ids]) if ids else {}
+
+    puts = []
+    deletes = []
+    now = utils.get_date_time()
+    for index, (item, result) in enumerate(zip(items, results)):
+        if result is not None:
+            continue
+        op = item['op']
+        if op == 'create':
+            data = dict(item['plan'])
+            if data['name'] in names:
+                results[index] = {'status': 400, 'error': 'A plan with that name already exists'}
+                continue
+            names.add(data['name'])
+            data['date_added'] = data['date_modified'] = now
+            data['price_table'] = pricing.build_price_table(data['price'])
+            entity = datastore.Entity(client.key('plans'))
+            entity.update(data)
+            puts.append((index, entity, {'status': 201}))
+            continue
+        plan = existing.get(item['id'])
+        if plan is None:
+            results[index] = {'status': 404, 'error': 'Not found', 'id': item['id']}
+        elif op == 'delete':
+            deletes.append((index, plan.key, {'status': 204, 'id': item['id']}))
+        else:
+            data = dict(item['plan'])
+            # Keep the parsed price table in sync with price. It can't be patched directly.
+            data.pop('price_table', None)
+            if 'price' in data:
+                data['price_table'] = pricing.build_price_table(data['price'])
+            data['date_modified'] = now
+            plan.update(data)
+            puts.append((index, plan, {'status': 200}))
+
+    _write(client, puts, results, client.put_multi)
+    _write(client, deletes, results, client.delete_multi)
+    written = sum(1 for result in results if result['status'] in (200, 201, 204))
+    for index, result in enumerate(results):
+        result['index'] = index
+    return results, written
+
+
+def changes(items, results):
+    '''
+    List the plans a batch wrote, for the catalog change record.
+    Arguments:
+        items: list of operations
+        results: list of results from run_batch
+    Returns:
+        list: (plan_id, operation)
+    '''
+    return [(result['id'], item['op']) for item, result in zip(items, results) if result['status'] in (200, 201, 204)]
@@ -0,0 +1,254 @@
+'''
+In-process cache of the plans kind. Every gunicorn worker keeps its own copy of the whole catalog.
+A cached copy is served until its TTL runs out. After that the catalog version stored in datastore is checked and
+the plans are only reloaded if the version changed. Admin write routes bump the version so other workers and
+instances drop their stale copies. Scripts that write plans outside the routes must bump it too.
+A copy is reloaded in full once it is older than max_age, whatever the version. If the reloaded plans differ from
+the copy, something wrote plans without bumping the version, and the version is bumped then so every worker and
+every cache keyed by the version drops its copy.
+Plans can be converted once when they are loaded (document), so requests serve ready-made dicts.
+Every version bump also appends a change record (plan_changes kind, one entity per version) with the IDs of the
+plans written and their operations. A worker whose copy is a few versions behind applies those changes to its copy
+instead of reloading the whole kind, and clients can do the same with GET /plans/changes.
+Classes: PlanCatalog
+'''
+import datetime, threading, time
+from google.cloud import datastore
+
+# Single entity holding the catalog version. Bumped by every plan write.
+VERSION_KIND = 'catalog'
+VERSION_NAME = 'plans'
+# Change records, keyed by the version they created.
+CHANGES_KIND = 'plan_changes'
+OPERATIONS = ('create', 'patch', 'delete')
+# A copy further behind than this (in versions, or in changed plans) is reloaded instead of updated.
+INCREMENTAL_MAX_VERSIONS = 50
+INCREMENTAL_MAX_PLANS = 500
+
+
+class _Snapshot:
+    '''
+    One loaded copy of the catalog and everything derived from it. Replaced as a whole on reload.
+    '''
+    def __init__(self, plans, by_id, version):
+        self.plans = plans
+        self.by_id = by_id
+        self.version = version
+        self.derived = {}
+
+
+class PlanCatalog:
+    '''
+    Cache for the plans kind.
+    Arguments:
+        client: datastore.Client
+        ttl: int, seconds a cached copy is trusted before the stored version is checked again
+        document: function (optional), converts each loaded datastore.Entity into the cached plan
+        max_age: int (optional), seconds after which a copy is reloaded in full even if the version didn't change
+    '''
+    def __init__(self, client, ttl=60, document=None, max_age=None):
+        self.client = client
+        self.ttl = ttl
+        self.document = document
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._expires = 0
+        self._stale = False
+        # When the copy was last loaded in full. Incremental updates only see writes that bumped the version.
+        self._loaded = 0
+
+    def plans(self):
+        '''
+        Get all the plans. The returned plans are shared between requests and must not be modified.
+        Returns:
+            list: plans
+        '''
+        return self._refresh().plans
+
+    def get(self, plan_id):
+        '''
+        Get a plan by ID.
+        Arguments:
+            plan_id: int
+        Returns:
+            plan (datastore.Entity, or the result of document)
+            None if the plan does not exist
+        '''
+        return self._refresh().by_id.get(plan_id)
+
+    def version(self):
+        '''
+        Get the catalog version of the cached copy.
+        Returns:
+            int: version
+        '''
+        return self._refresh().version
+
+    def latest_version(self):
+        '''
+        Get the catalog version without loading the plans. The cached copy's version is used while its TTL lasts,
+        after that the version is read from datastore.
+        Returns:
+            int: version
+        '''
+        snapshot = self._snapshot
+        if snapshot and not self._stale and time.monotonic() < self._expires:
+            return snapshot.version
+        return self._stored_version()
+
+    def derived(self, name, build):
+        '''
+        Get a value computed from the cached plans, such as an index. It is built once per loaded copy.
+        Arguments:
+            name: str
+            build: function, called with the list of plans
+        Returns:
+            the value returned by build
+        '''
+        snapshot = self._refresh()
+        if name not in snapshot.derived:
+            with self._lock:
+                if name not in snapshot.derived:
+                    snapshot.derived[name] = build(snapshot.plans)
+        return snapshot.derived[name]
+
+    def invalidate(self):
+        '''
+        Drop the cached copy. The next read reloads the plans from datastore.
+        Readers keep using the old copy until the new one is loaded.
+        '''
+        with self._lock:
+            self._expires = 0
+            self._stale = True
+
+    def bump_version(self, changes=None):
+        '''
+        Increment the stored catalog version and drop the local copy. Call after every write to the plans kind.
+        The change record for the new version is written in the same transaction.
+        Arguments:
+            changes: list (optional) of (plan_id, operation), operation is create, patch or delete.
+                     Without changes, workers and clients can't update their copies and reload everything.
+        Returns:
+            int: new version
+        '''
+        version = self._bump(changes)
+        self.invalidate()
+        return version
+
+    def changes_since(self, version, limit=None):
+        '''
+        Get the change records after a version, oldest first.
+        Arguments:
+            version: int
+            limit: int (optional), most records returned
+        Returns:
+            list: records (dict: version, changes list of (plan_id, operation))
+            None if the records don't go back to version, or one of them doesn't list its plans. The whole
+            catalog has to be read again in that case.
+        '''
+        if version > 0:
+            # The record of version itself proves that nothing before it is needed.
+            query = self.client.query(kind=CHANGES_KIND)
+            query.add_filter(filter=datastore.query.PropertyFilter('version', '>=', version))
+            query.order = ['version']
+            records = list(query.fetch(limit=None if limit is None else limit + 1))
+            if not records or records[0]['version'] != version:
+                return None
+            records = records[1:]
+        else:
+            query = self.client.query(kind=CHANGES_KIND)
+            query.order = ['version']
+            records = list(query.fetch(limit=limit))
+            if records and records[0]['version'] != 1:
+                return None
+        if not all(record.get('complete') for record in records):
+            return None
+        return [{'version': record['version'], 'changes': list(zip(record['plan_ids'], record['ops']))}
+                for record in records]
+
+    def _bump(self, changes):
+        key = self.client.key(VERSION_KIND, VERSION_NAME)
+        with self.client.transaction():
+            entity = self.client.get(key) or datastore.Entity(key)
+            entity['version'] = entity.get('version', 0) + 1
+            record = datastore.Entity(self.client.key(CHANGES_KIND, entity['version']),
+                                      exclude_from_indexes=('plan_ids', 'ops'))
+            record.update({
+                'version': entity['version'],
+                'date': datetime.datetime.now(datetime.timezone.utc),
+                'complete': changes is not None,
+                'plan_ids': [plan_id for plan_id, _ in changes or ()],
+                'ops': [op for _, op in changes or ()],
+            })
+            self.client.put_multi([entity, record])
+        return entity['version']
+
+    def _stored_version(self):
+        entity = self.client.get(self.client.key(VERSION_KIND, VERSION_NAME))
+        if not entity:
+            return 0
+        return entity.get('version', 0)
+
+    def _update(self, snapshot, version):
+        '''
+        Apply the change records after the snapshot's version to a copy of it.
+        Returns None if a full reload is needed.
+        '''
+        if version - snapshot.version > INCREMENTAL_MAX_VERSIONS:
+            return None
+        records = self.changes_since(snapshot.version)
+        if records is None or not records or records[-1]['version'] < version:
+            return None
+        changed = {}
+        for record in records:
+            changed.update(record['changes'])
+        if len(changed) > INCREMENTAL_MAX_PLANS:
+            return None
+
+        by_id = dict(snapshot.by_id)
+        found = self.client.get_multi([self.client.key('plans', plan_id) for plan_id in changed])
+        for plan_id in changed:
+            by_id.pop(plan_id, None)
+        for entity in found:
+            by_id[entity.id] = self.document(entity) if self.document else entity
+        # Same order as a full load, which reads the plans in key order.
+        plans = [by_id[plan_id] for plan_id in sorted(by_id)]
+        return _Snapshot(plans, by_id, records[-1]['version'])
+
+    def _load(self, version):
+        entities = list(self.client.query(kind='plans').fetch())
+        plans = [self.document(entity) for entity in entities] if self.document else entities
+        by_id = {entity.id: plan for entity, plan in zip(entities, plans)}
+        return _Snapshot(plans, by_id, version)
+
+    def _refresh(self):
+        snapshot = self._snapshot
+        if snapshot and time.monotonic() < self._expires:
+            return snapshot
+        # Only one thread per worker reloads. The others wait and then use the fresh copy.
+        with self._lock:
+            if self._snapshot and time.monotonic() < self._expires:
+                return self._snapshot
+            # Read the version before the plans. A write in between leaves us with newer plans and an older
+            # version, which only causes one extra reload.
+            version = self._stored_version()
+            old = self._snapshot
+            expired = self.max_age is not None and time.monotonic() - self._loaded > self.max_age
+            if not old or self._stale or expired or version != old.version:
+                updated = None
+                if old and not expired and version > old.version:
+                    updated = self._update(old, version)
+                if updated:
+                    self._snapshot = updated
+                else:
+                    self._snapshot = self._load(version)
+                    self._loaded = time.monotonic()
+                    if old and expired and version == old.version and self._snapshot.plans != old.plans:
+                        # Plans were written without a version bump. The new copy keeps the version it was read
+                        # with, so this worker reloads once more after the bump, like every other one.
+                        print(f'Plans changed without a catalog version bump, bumping version {version}')
+                        self._bump(None)
+                self._stale = False
+            self._expires = time.monotonic() + self.ttl
+            return self._snapshot
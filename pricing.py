@@ -0,0 +1,57 @@
+'''
+Plan price parsing. Admins enter price as a dict of line count to amount string, e.g. {"1": "$65", "2": "$120.00"}.
+The price table is the same dict with numeric monthly totals. It is computed once when a plan is written and
+stored on the plan as price_table, so recommendations compare numbers instead of parsing strings.
+Functions: build_price_table, get_price_table
+Exceptions: build_price_table returns 0 if the price can't be parsed.
+'''
+import re
+
+_AMOUNT = re.compile(r'\d+(?:\.\d+)?')
+
+
+def _parse_amount(amount):
+    if isinstance(amount, bool):
+        return None
+    if isinstance(amount, (int, float)):
+        return float(amount)
+    if not isinstance(amount, str):
+        return None
+    match = _AMOUNT.search(amount.replace(',', ''))
+    if not match:
+        return None
+    return float(match.group())
+
+
+def build_price_table(price):
+    '''
+    Build the numeric price table for a plan.
+    Arguments:
+        price: dict {lines: amount}, amount is a string like "$120.00" or a number
+    Returns:
+        dict: {lines: float}, monthly total for that many lines
+        0 if the price is not a dict or an amount can't be parsed
+    '''
+    if not isinstance(price, dict) or not price:
+        return 0
+    table = {}
+    for lines, amount in price.items():
+        value = _parse_amount(amount)
+        if value is None or not str(lines).isdigit():
+            return 0
+        table[str(lines)] = value
+    return table
+
+
+def get_price_table(plan):
+    '''
+    Get the price table of a plan. Plans written before price_table existed are parsed on the fly.
+    Arguments:
+        plan: datastore.Entity or dict
+    Returns:
+        dict: {lines: float}, empty if the plan has no valid price
+    '''
+    table = plan.get('price_table')
+    if isinstance(table, dict):
+        return table
+    return build_price_table(plan.get('price')) or {}
@@ -0,0 +1,150 @@
+'''
+Token bucket rate limiting per route and client IP for the unauthenticated routes.
+Each limit in RATE_LIMITS has a refill rate (requests per second) and a burst size. A request takes one token from
+the bucket of its route and client IP. When the bucket is empty the request gets a 429 with Retry-After.
+Buckets are kept in memory by each worker unless RATE_LIMIT_REDIS_URL is set, then they are shared by every
+instance through redis. The redis package is only needed in that case. Any backend with a take method can be set
+with set_backend, e.g. a local stand-in for redis in tests.
+If the shared backend fails, requests are let through.
+Classes: MemoryBackend, RedisBackend
+Functions: init_app, set_backend, limit, client_ip
+'''
+import math, threading, time
+from functools import wraps
+from cachetools import LRUCache
+from flask import current_app, request
+
+ERROR_429 = {"Error": "Too many requests"}
+
+# Takes one token atomically. Returns the seconds until a token is available, 0 if one was taken.
+_TAKE_SCRIPT = '''
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'time')
+local tokens = tonumber(state[1]) or burst
+local last = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - last) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'time', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+'''
+
+
+class MemoryBackend:
+    '''
+    Buckets kept by this worker. The least recently used buckets are dropped past maxsize, a dropped bucket is full.
+    Arguments:
+        maxsize: int, number of buckets kept
+    '''
+    def __init__(self, maxsize=10000):
+        self._lock = threading.Lock()
+        self._buckets = LRUCache(maxsize=maxsize)
+
+    def take(self, key, rate, burst):
+        '''
+        Take a token from a bucket.
+        Arguments:
+            key: str, route and client
+            rate: float, tokens added per second
+            burst: int, bucket size
+        Returns:
+            float: seconds until a token is available, 0 if one was taken
+        '''
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            self._buckets[key] = (tokens - 1 if wait == 0 else tokens, now)
+            return wait
+
+
+class RedisBackend:
+    '''
+    Buckets shared by every instance, stored in redis and updated by a script so a take is atomic.
+    Arguments:
+        redis_client: redis.Redis, or any object with register_script
+        prefix: str, prepended to the bucket keys
+    '''
+    def __init__(self, redis_client, prefix='rate:'):
+        self.prefix = prefix
+        self._take = redis_client.register_script(_TAKE_SCRIPT)
+
+    def take(self, key, rate, burst):
+        '''
+        Take a token from a bucket. See MemoryBackend.take.
+        '''
+        return float(self._take(keys=[self.prefix + key], args=[rate, burst]))
+
+
+def init_app(app):
+    '''
+    Create the backend for the app: redis when RATE_LIMIT_REDIS_URL is set, memory otherwise.
+    Arguments:
+        app: Flask
+    '''
+    url = app.config['RATE_LIMIT_REDIS_URL']
+    if url:
+        import redis
+        backend = RedisBackend(redis.Redis.from_url(url, socket_timeout=app.config['RATE_LIMIT_REDIS_TIMEOUT']))
+    else:
+        backend = MemoryBackend(maxsize=app.config['RATE_LIMIT_MEMORY_KEYS'])
+    set_backend(app, backend)
+
+
+def set_backend(app, backend):
+    '''
+    Replace the backend of the app.
+    Arguments:
+        app: Flask
+        backend: object with take(key, rate, burst)
+    '''
+    app.extensions['rate_limit'] = backend
+
+
+def client_ip():
+    '''
+    Get the IP of the client. The load balancer appends the address it received the request from to
+    X-Forwarded-For, after anything the client sent, so the client is RATE_LIMIT_PROXY_HOPS entries from the end.
+    Returns:
+        str: IP address
+    '''
+    route = request.access_route
+    hops = current_app.config['RATE_LIMIT_PROXY_HOPS']
+    if 'X-Forwarded-For' in request.headers and len(route) > hops:
+        return route[-1 - hops]
+    return request.remote_addr or ''
+
+
+def limit(name):
+    '''
+    Decorator that rate limits a route with the RATE_LIMITS entry for name. Routes sharing a name share buckets.
+    Arguments:
+        name: str
+    Returns:
+        function: decorator
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            setting = current_app.config['RATE_LIMITS'].get(name)
+            if setting:
+                rate, burst = setting
+                try:
+                    wait = current_app.extensions['rate_limit'].take(f'{name}:{client_ip()}', rate, burst)
+                except Exception as e:
+                    print(f'Rate limit check failed: {e}')
+                    wait = 0
+                if wait > 0:
+                    return ERROR_429, 429, {'Retry-After': str(math.ceil(wait))}
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,167 @@
+'''
+Result cache for the recommend route. Most requests are built from a small set of choices (line count, common
+data tiers, the major carriers), so identical requests are answered from memory.
+Requests are normalized first so that equivalent bodies share one entry. Entries belong to one catalog version
+and the cache is emptied as soon as a request sees a newer version, so plan writes invalidate it.
+Identical requests that miss the cache at the same time are coalesced (SingleFlight): one computes the response and
+the others wait for it.
+Classes: ResultCache, SingleFlight
+Functions: normalize_request
+'''
+import threading
+from cachetools import LRUCache
+
+
+def normalize_request(params):
+    '''
+    Build the cache key for a parsed recommend request. Carriers are sorted and deduplicated since their order
+    doesn't matter. Preferred carriers keep their order since it is a ranking.
+    Arguments:
+        params: dict, keyword arguments for RecommendationEngine.recommend
+    Returns:
+        tuple: key
+    '''
+    carriers = params.get('carriers')
+    preferred = params.get('preferred_carriers')
+    return (
+        str(params['lines']),
+        tuple(sorted((params.get('minimums') or {}).items())),
+        None if carriers is None else tuple(sorted(set(carriers))),
+        params.get('max_price'),
+        bool(params.get('payoff')),
+        params.get('order'),
+        params.get('limit'),
+        params.get('offset', 0),
+        tuple(preferred) if preferred else None,
+    )
+
+
+class ResultCache:
+    '''
+    Thread safe LRU cache of recommend responses for one catalog version at a time.
+    Arguments:
+        maxsize: int, number of responses kept
+    '''
+    def __init__(self, maxsize=1024):
+        self._lock = threading.Lock()
+        self._entries = LRUCache(maxsize=maxsize)
+        self._version = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, version, key):
+        '''
+        Get a cached response.
+        Arguments:
+            version: int, current catalog version
+            key: tuple from normalize_request
+        Returns:
+            the cached response
+            None on a miss
+        '''
+        with self._lock:
+            value = self._entries.get(key) if self._check_version(version) else None
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def set(self, version, key, value):
+        '''
+        Cache a response computed from the given catalog version.
+        '''
+        with self._lock:
+            if self._check_version(version):
+                self._entries[key] = value
+
+    def clear(self):
+        '''
+        Drop every cached response.
+        '''
+        with self._lock:
+            self._entries.clear()
+            self._version = None
+
+    def stats(self):
+        '''
+        Get the cache counters.
+        Returns:
+            dict: hits, misses, hit_ratio, invalidations, size, maxsize
+        '''
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0,
+                'invalidations': self.invalidations,
+                'size': len(self._entries),
+                'maxsize': self._entries.maxsize,
+            }
+
+    def _check_version(self, version):
+        '''
+        Move the cache to a newer catalog version. Returns False if version is older than the cached one.
+        '''
+        if version == self._version:
+            return True
+        # A request that read an older copy of the catalog may finish after one that read a newer copy.
+        if self._version is not None and version < self._version:
+            return False
+        if self._entries:
+            self.invalidations += 1
+        self._entries.clear()
+        self._version = version
+        return True
+
+
+class SingleFlight:
+    '''
+    Runs a function once for concurrent callers with the same key. Callers that arrive while it runs wait and get
+    the same result, or the same exception.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+
+    def do(self, key, func):
+        '''
+        Call func, or wait for the call already running for key.
+        Arguments:
+            key: hashable
+            func: function without arguments
+        Returns:
+            the result of func
+        '''
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
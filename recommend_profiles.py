@@ -0,0 +1,195 @@
+'''
+Precomputed responses of the recommend route for the most common requests.
+Most requests fall into a few profiles: a line count, a standard data tier and unlimited talk and text or no
+minimum. Every combination of the values in RECOMMEND_PROFILES is computed once per catalog version, after plan
+writes, by cron or when a request sees a version without them, and kept as serialized JSON. A matching request is
+answered with one dict lookup and no serialization. Anything else is computed by the route as before.
+The serialized responses can also be stored in one datastore entity, so other instances load them with a single
+lookup instead of computing them.
+Classes: ProfileStore
+Functions: expand_grid, build_response
+'''
+import hashlib, itertools, threading, time, zlib
+import orjson
+from google.cloud import datastore
+import recommend_cache, utils
+from recommender import ALLOWANCE_FIELDS
+
+ENTITY_KIND = 'recommend_profiles'
+ENTITY_NAME = 'latest'
+# Datastore entities can't be larger than 1 MiB.
+MAX_ENTITY_BYTES = 1000000
+
+
+def build_response(engine, params):
+    '''
+    Compute a recommend response. Shared with the recommend route so both build the same responses.
+    Arguments:
+        engine: recommender.RecommendationEngine
+        params: dict, keyword arguments for recommend. limit is the page size plus one, the extra plan tells
+                whether there is another page.
+    Returns:
+        dict: results, next_cursor (only when there is another page)
+    '''
+    results = engine.recommend(**params)
+    response = {}
+    limit = params.get('limit')
+    if limit is not None and len(results) >= limit:
+        results = results[:limit - 1]
+        response['next_cursor'] = utils.encode_cursor({'offset': params.get('offset', 0) + limit - 1})
+    # The engine is built from the cached plans, which already have their id and self link.
+    response['results'] = results
+    return response
+
+
+def expand_grid(grid):
+    '''
+    List the recommend parameters for every combination of the grid values.
+    Arguments:
+        grid: dict, lines, sort and limit (page size) and the allowance fields, each a list of values.
+              None in an allowance field means no minimum, in limit it means every plan.
+    Returns:
+        list: params, the way the recommend route builds them
+    '''
+    if not grid:
+        return []
+    fields = [field for field in ALLOWANCE_FIELDS if field in grid]
+    profiles = []
+    for lines, order, limit, *minimums in itertools.product(
+            grid['lines'], grid.get('sort', ['price']), grid.get('limit', [None]), *(grid[field] for field in fields)):
+        profiles.append({
+            'lines': lines,
+            'carriers': None,
+            'minimums': {field: value for field, value in zip(fields, minimums) if value is not None},
+            'max_price': None,
+            'payoff': False,
+            'order': order,
+            'limit': None if limit is None else limit + 1,
+            'offset': 0,
+            'preferred_carriers': None,
+        })
+    return profiles
+
+
+class ProfileStore:
+    '''
+    Serialized recommend responses for the profiles of the grid, for one catalog version at a time.
+    Arguments:
+        grid: dict, see expand_grid
+        client: datastore.Client (optional), share the responses through datastore
+    '''
+    def __init__(self, grid, client=None):
+        self.profiles = expand_grid(grid)
+        self.keys = [recommend_cache.normalize_request(params) for params in self.profiles]
+        self.client = client
+        # Stored responses are only used by instances with the same grid.
+        self.fingerprint = hashlib.sha1(orjson.dumps(grid, option=orjson.OPT_SORT_KEYS)).hexdigest()[:16]
+        self._lock = threading.Lock()
+        # Catalog version and responses by request key, replaced together.
+        self._current = (None, {})
+        self._pending = None
+        self.hits = 0
+        self.seconds = 0
+        self.source = None
+
+    def get(self, version, key):
+        '''
+        Get the serialized response of a profile.
+        Arguments:
+            version: int, catalog version of the request
+            key: tuple from recommend_cache.normalize_request
+        Returns:
+            bytes: JSON response
+            None if the request isn't a profile or the profiles aren't built for this version
+        '''
+        built, blobs = self._current
+        if version != built:
+            return None
+        blob = blobs.get(key)
+        if blob is not None:
+            self.hits += 1
+        return blob
+
+    @property
+    def version(self):
+        '''
+        Catalog version of the profiles, None before the first build.
+        '''
+        return self._current[0]
+
+    def behind(self, version):
+        '''
+        Check if the profiles have to be built for a version, and aren't being built already.
+        '''
+        return bool(self.profiles) and version != self.version and version != self._pending
+
+    def refresh(self, version, get_engine):
+        '''
+        Build the profiles for a catalog version: load them from datastore if another instance stored them for
+        that version, compute them otherwise and store them. Does nothing if they are already built or being built.
+        Arguments:
+            version: int, read before the engine
+            get_engine: function returning the recommender.RecommendationEngine of the catalog
+        Returns:
+            bool: True if the profiles were built by this call
+        '''
+        with self._lock:
+            if not self.profiles or version == self.version or version == self._pending:
+                return False
+            self._pending = version
+        try:
+            start = time.perf_counter()
+            blobs = self._load(version) if self.client else None
+            source = 'datastore'
+            if blobs is None:
+                engine = get_engine()
+                blobs = [orjson.dumps(build_response(engine, params)) for params in self.profiles]
+                source = 'computed'
+                if self.client:
+                    self._save(version, blobs)
+            with self._lock:
+                # A slower build of an older version must not replace a newer one.
+                if self.version is None or version > self.version:
+                    self._current = (version, dict(zip(self.keys, blobs)))
+                    self.seconds = time.perf_counter() - start
+                    self.source = source
+            return True
+        finally:
+            with self._lock:
+                if self._pending == version:
+                    self._pending = None
+
+    def stats(self):
+        '''
+        Get the state of the store.
+        Returns:
+            dict: profiles, version, hits, bytes, seconds (last build), source (computed or datastore)
+        '''
+        with self._lock:
+            return {'profiles': len(self.profiles), 'version': self.version, 'hits': self.hits,
+                    'bytes': sum(len(blob) for blob in self._current[1].values()), 'seconds': round(self.seconds, 4),
+                    'source': self.source}
+
+    def _load(self, version):
+        entity = self.client.get(self.client.key(ENTITY_KIND, ENTITY_NAME))
+        if not entity or entity.get('version') != version or entity.get('grid') != self.fingerprint:
+            return None
+        # orjson escapes newlines inside strings, so one JSON document per line.
+        blobs = zlib.decompress(entity['blob']).split(b'\n')
+        return blobs if len(blobs) == len(self.profiles) else None
+
+    def _save(self, version, blobs):
+        blob = zlib.compress(b'\n'.join(blobs))
+        if len(blob) > MAX_ENTITY_BYTES:
+            print(f'Recommend profiles not stored, {len(blob)} bytes compressed')
+            return
+        key = self.client.key(ENTITY_KIND, ENTITY_NAME)
+        with self.client.transaction():
+            # Another instance may have stored a newer version in the meantime.
+            entity = self.client.get(key)
+            if entity and entity.get('version', 0) > version:
+                return
+            entity = datastore.Entity(key, exclude_from_indexes=('blob',))
+            entity.update({'version': version, 'grid': self.fingerprint, 'blob': blob,
+                           'date': utils.get_date_time()})
+            self.client.put(entity)
@@ -0,0 +1,302 @@
+'''
+In-memory recommendation engine. Replaces the datastore inequality queries in the recommend route.
+The catalog is stored column by column. Every allowance (data, hotspot, talk, text) has a sorted index and every
+carrier and line count has a bitmap of the plans that match it.
+Monthly prices are stored per line count as numeric columns, so results can be filtered by a maximum price and
+ordered by total cost.
+Results can also be ranked by a score that weighs price per line, surplus data and hotspot over the requested
+amounts and carrier preference. When only the first results are needed they are selected with a heap instead of
+sorting every match.
+Allowances only take a handful of distinct values (plan tiers), so each allowance also keeps one bitmap per
+distinct value with the plans that match or beat it. A query is then an AND of a few bitmaps. Allowances with too
+many distinct values fall back to the sorted index: the query starts from the most selective one and checks the
+rest of the thresholds for each candidate.
+Classes: RecommendationEngine
+'''
+from bisect import bisect_left
+from itertools import compress
+import heapq, math, re
+import pricing
+
+ALLOWANCE_FIELDS = ('data', 'hotspot', 'talk', 'text')
+
+# Weights of the ranking score. Price per line is in dollars, surplus allowances are on a log scale and carrier
+# preference is between 0 and 1.
+DEFAULT_WEIGHTS = {'price': 1.0, 'data': 4.0, 'hotspot': 2.0, 'carrier': 10.0}
+
+# Above this many distinct values an allowance is only served by its sorted index.
+MAX_THRESHOLD_BITMAPS = 256
+
+# Maps the digits of bin() to the bytes 0 and 1.
+_BINARY_DIGITS = bytes.maketrans(b'01', b'\x00\x01')
+_ONE = re.compile('1')
+# _bits searches for set bits when fewer than one in SPARSE_RATIO is set.
+SPARSE_RATIO = 5
+
+
+class RecommendationEngine:
+    '''
+    Read only index over a list of plans. Build a new engine when the catalog changes.
+    Arguments:
+        plans: list of plans (datastore.Entity or dict)
+    '''
+    def __init__(self, plans):
+        self.plans = list(plans)
+        size = len(self.plans)
+        self._size = size
+
+        # Columns hold the allowance of every plan by position. None means the plan can never match a filter
+        # on that field, the same as a missing or non integer property in datastore.
+        self.columns = {}
+        self.indexes = {}
+        self.threshold_bitmaps = {}
+        for field in ALLOWANCE_FIELDS:
+            column = [plan.get(field) if _is_int(plan.get(field)) else None for plan in self.plans]
+            order = sorted((i for i in range(size) if column[i] is not None), key=column.__getitem__)
+            values = [column[i] for i in order]
+            self.columns[field] = column
+            self.indexes[field] = (values, order)
+            self.threshold_bitmaps[field] = _threshold_bitmaps(values, order, size)
+
+        # Bitmaps are python ints with bit i set when plan i matches.
+        carriers = {}
+        line_counts = {}
+        payoff = []
+        # Monthly total by line count, then by plan position. None when the plan has no price for that line count.
+        self.prices = {}
+        for i, plan in enumerate(self.plans):
+            carriers.setdefault(plan.get('carrier'), []).append(i)
+            # Line counts are the keys of the price dict.
+            for lines in plan.get('price') or {}:
+                line_counts.setdefault(lines, []).append(i)
+            for lines, amount in pricing.get_price_table(plan).items():
+                # setdefault would build a catalog sized list for every plan, only allocate a new line count.
+                column = self.prices.get(lines)
+                if column is None:
+                    column = self.prices[lines] = [None] * size
+                column[i] = amount
+            if plan.get('payoff'):
+                payoff.append(i)
+        self.carrier_bitmaps = {carrier: _bitmap(positions, size) for carrier, positions in carriers.items()}
+        self.line_bitmaps = {lines: _bitmap(positions, size) for lines, positions in line_counts.items()}
+        self.payoff_bitmap = _bitmap(payoff, size)
+
+    def recommend(self, lines, carriers=None, minimums=None, max_price=None, payoff=False, order=None, limit=None,
+                  offset=0, preferred_carriers=None, weights=None):
+        '''
+        Get the plans that offer the number of lines, are sold by one of the carriers and match or beat every
+        minimum allowance.
+        Arguments:
+            lines: int or str
+            carriers: list (optional), None for any carrier
+            minimums: dict {field: int} (optional), keys from ALLOWANCE_FIELDS
+            max_price: float (optional), highest monthly total for the number of lines
+            payoff: bool (optional), only plans that pay off device financing
+            order: str (optional), 'price' for cheapest first, 'score' for best score first, None for catalog order
+            limit: int (optional), number of plans to return
+            offset: int (optional), number of ordered plans to skip
+            preferred_carriers: list (optional), most preferred first, used by the score
+            weights: dict (optional), overrides DEFAULT_WEIGHTS, used by the score
+        Returns:
+            list: plans
+        '''
+        positions = self.match(lines, carriers, minimums, max_price, payoff)
+        # Only offset + limit plans have to be ordered. The rest are never returned.
+        count = None if limit is None else offset + limit
+        if order == 'price':
+            positions = self.sort_by_price(positions, lines, count)
+        elif order == 'score':
+            positions = self.rank(positions, lines, count, minimums, preferred_carriers, weights)
+        end = None if limit is None else offset + limit
+        return [self.plans[i] for i in positions[offset:end]]
+
+    def price(self, position, lines):
+        '''
+        Get the monthly total of a plan for a number of lines.
+        Arguments:
+            position: int, position in self.plans
+            lines: int or str
+        Returns:
+            float: price
+            None if the plan has no price for that many lines
+        '''
+        column = self.prices.get(str(lines))
+        return column[position] if column else None
+
+    def sort_by_price(self, positions, lines, count=None):
+        '''
+        Order plan positions by monthly total for the number of lines. Plans without a price go last.
+        Ties keep their catalog order.
+        Arguments:
+            positions: list
+            lines: int or str
+            count: int (optional), only return the first count positions
+        Returns:
+            list: positions
+        '''
+        column = self.prices.get(str(lines)) or [None] * self._size
+        key = lambda i: (column[i] is None, column[i] or 0, i)
+        if count is not None and count < len(positions):
+            return heapq.nsmallest(count, positions, key=key)
+        return sorted(positions, key=key)
+
+    def score(self, position, lines, minimums=None, preferred_carriers=None, weights=None):
+        '''
+        Score a plan for a request. Higher is better.
+        Cheaper price per line raises the score, as do data and hotspot beyond the requested minimums and a
+        carrier earlier in the preferred list.
+        Arguments:
+            position: int, position in self.plans
+            lines: int or str
+            minimums: dict {field: int} (optional)
+            preferred_carriers: list (optional), most preferred first
+            weights: dict (optional), overrides DEFAULT_WEIGHTS
+        Returns:
+            float: score
+        '''
+        weights = {**DEFAULT_WEIGHTS, **(weights or {})}
+        minimums = minimums or {}
+        price = self.price(position, lines)
+        if price is None:
+            return -math.inf
+        score = -weights['price'] * price / max(int(lines), 1)
+        for field in ('data', 'hotspot'):
+            value = self.columns[field][position]
+            if value is not None:
+                score += weights[field] * math.log1p(max(value - minimums.get(field, 0), 0))
+        if preferred_carriers:
+            carrier = self.plans[position].get('carrier')
+            if carrier in preferred_carriers:
+                rank = preferred_carriers.index(carrier)
+                score += weights['carrier'] * (len(preferred_carriers) - rank) / len(preferred_carriers)
+        return score
+
+    def rank(self, positions, lines, count=None, minimums=None, preferred_carriers=None, weights=None):
+        '''
+        Order plan positions by score, best first. Ties keep their catalog order.
+        With count only the best count positions are selected, in O(n log count).
+        Arguments:
+            positions: list
+            lines: int or str
+            count: int (optional), only return the first count positions
+            minimums, preferred_carriers, weights: see score
+        Returns:
+            list: positions
+        '''
+        scores = {i: self.score(i, lines, minimums, preferred_carriers, weights) for i in positions}
+        key = lambda i: (-scores[i], i)
+        if count is not None and count < len(positions):
+            return heapq.nsmallest(count, positions, key=key)
+        return sorted(positions, key=key)
+
+    def match(self, lines, carriers=None, minimums=None, max_price=None, payoff=False):
+        '''
+        Same as recommend but returns the positions of the matching plans in self.plans, in catalog order.
+        '''
+        mask = self.line_bitmaps.get(str(lines), 0)
+        if payoff:
+            mask &= self.payoff_bitmap
+        if carriers is not None:
+            carrier_mask = 0
+            for carrier in carriers:
+                carrier_mask |= self.carrier_bitmaps.get(carrier, 0)
+            mask &= carrier_mask
+
+        remaining = {}
+        for field, minimum in (minimums or {}).items():
+            if not mask:
+                break
+            thresholds = self.threshold_bitmaps[field]
+            if thresholds is None:
+                remaining[field] = minimum
+                continue
+            values, bitmaps = thresholds
+            k = bisect_left(values, minimum)
+            mask &= bitmaps[k] if k < len(bitmaps) else 0
+        if not mask:
+            return []
+        if not remaining:
+            return self._within_price(_bits(mask), lines, max_price)
+
+        # Start from the sorted index that leaves the fewest candidates.
+        starts = {field: bisect_left(self.indexes[field][0], minimum) for field, minimum in remaining.items()}
+        driver = min(starts, key=lambda field: len(self.indexes[field][0]) - starts[field])
+        candidates = self.indexes[driver][1][starts[driver]:]
+
+        checks = [(self.columns[field], minimum) for field, minimum in remaining.items() if field != driver]
+        # One byte lookup per candidate is much cheaper than shifting a large int.
+        mask_bytes = mask.to_bytes((self._size + 7) // 8, 'little')
+        results = []
+        for i in candidates:
+            if not mask_bytes[i >> 3] >> (i & 7) & 1:
+                continue
+            for column, minimum in checks:
+                value = column[i]
+                if value is None or value < minimum:
+                    break
+            else:
+                results.append(i)
+        results.sort()
+        return self._within_price(results, lines, max_price)
+
+    def _within_price(self, positions, lines, max_price):
+        if max_price is None:
+            return positions
+        column = self.prices.get(str(lines))
+        if not column:
+            return []
+        return [i for i in positions if column[i] is not None and column[i] <= max_price]
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _threshold_bitmaps(values, order, size):
+    '''
+    Build one bitmap per distinct value with the plans whose value is greater than or equal to it.
+    Arguments:
+        values: sorted list of values
+        order: list of plan positions in the same order as values
+        size: int, number of plans
+    Returns:
+        tuple: (distinct values, bitmaps)
+        None if there are more than MAX_THRESHOLD_BITMAPS distinct values
+    '''
+    groups = {}
+    for value, i in zip(values, order):
+        groups.setdefault(value, []).append(i)
+    if len(groups) > MAX_THRESHOLD_BITMAPS:
+        return None
+    distinct = sorted(groups)
+    bitmaps = []
+    mask = 0
+    for value in reversed(distinct):
+        mask |= _bitmap(groups[value], size)
+        bitmaps.append(mask)
+    bitmaps.reverse()
+    return distinct, bitmaps
+
+
+def _bitmap(positions, size):
+    '''
+    Build a bitmap with the given positions set.
+    '''
+    data = bytearray((size + 7) // 8)
+    for i in positions:
+        data[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(data, 'little')
+
+
+def _bits(mask):
+    '''
+    Positions of the set bits of mask in ascending order.
+    '''
+    # bin() lists the bits from the highest down, reversed it lists them by position.
+    digits = bin(mask)[:1:-1]
+    if mask.bit_count() * SPARSE_RATIO < len(digits):
+        # Few matches: searching for the ones skips the zeros in C instead of visiting every position.
+        return [match.start() for match in _ONE.finditer(digits)]
+    # Many matches: mapped to 0/1 bytes the digits work as a selector for compress, which keeps the loop in C.
+    selectors = digits.encode().translate(_BINARY_DIGITS)
+    return list(compress(range(len(selectors)), selectors))
@@ -1,14 +1,13 @@
 '''
 Decorators to be used for authorization. Any route/function decorated requires authentication and a valid JWT.
-Decorators: admin_required, user_required (not implemented), representative_required (not implemented).
+Decorators: admin_required, cron_required, metrics_required, user_required (not implemented), representative_required (not implemented).
 Exceptions: ExpiredSignatureError, InvalidTokenError.
 '''
+import hmac
 from functools import wraps
-from flask import request
-from jwt import ExpiredSignatureError, InvalidTokenError
-from os import environ
-import jwt
+from flask import request, current_app
 from jwt.exceptions import ExpiredSignatureError, InvalidTokenError
+from security import tokens
 
 def admin_required(func):
     '''
@@ -30,15 +29,17 @@ def admin_required(func):
         token = headers["Authorization"]
 
         # Remove "Bearer " prefix from token
-        token = token.split(" ")[1]
-        PUBLIC_KEY = environ.get("PUBLIC_KEY", "")
-        
-        if not PUBLIC_KEY:
+        parts = token.split(" ")
+        if len(parts) != 2:
+            return {"error": "Invalid token"}, 401
+        token = parts[1]
+
+        if current_app.config.get("PUBLIC_KEY_OBJECT") is None:
             return {"Error": "Public key not found"}, 500
 
         try:
-            # Decode the JWT
-            decoded = jwt.decode(token, PUBLIC_KEY, algorithms=["RS256"])
+            # Decode the JWT. Tokens verified earlier are served from the verification cache.
+            decoded = tokens.verify_token(token)
 
             # Check if the user has the 'admin' role
             if "roles" not in decoded or "admin" not in decoded["roles"]:
@@ -53,3 +54,45 @@ def admin_required(func):
         return func(*args, **kwargs)
 
     return wrapper
+
+
+def cron_required(func):
+    '''
+    Decorator for routes called by App Engine cron. App Engine adds the X-Appengine-Cron header to cron requests and
+    strips it from requests coming from outside, so it can be trusted.
+    Arguments:
+        func: function
+    Returns:
+        function: wrapper
+    '''
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if request.headers.get("X-Appengine-Cron") != "true":
+            return {"error": "Forbidden: cron only"}, 403
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
+def metrics_required(func):
+    '''
+    Decorator for the metrics route. Scrapers send METRICS_TOKEN as a bearer token, since JWTs expire.
+    Without METRICS_TOKEN the route is for admins, like admin_required.
+    Arguments:
+        func: function
+    Returns:
+        function: wrapper
+    '''
+    admin_func = admin_required(func)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        expected = current_app.config.get("METRICS_TOKEN")
+        if not expected:
+            return admin_func(*args, **kwargs)
+        token = request.headers.get("Authorization", "")
+        if not hmac.compare_digest(token.encode(), f"Bearer {expected}".encode()):
+            return {"error": "Invalid token"}, 401
+        return func(*args, **kwargs)
+
+    return wrapper
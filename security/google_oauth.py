@@ -0,0 +1,141 @@
+'''
+Outbound calls to Google for the OAuth callback: the code for token exchange and ID token verification.
+Both go through one pooled requests.Session per worker, so TLS connections to Google are kept alive between logins.
+Google's signing certificates are cached for as long as their Cache-Control max-age allows instead of being
+downloaded on every login. Every call has a timeout (HTTP_TIMEOUT).
+Classes: CachingRequest
+Functions: exchange_code, verify_id_token, prefetch_certs, certs_cached
+Exceptions: verify_id_token raises ValueError for invalid tokens, like google.oauth2.id_token.
+'''
+import re, threading, time
+import requests
+from flask import current_app
+import metrics
+from google.auth.transport import requests as google_requests
+from google.oauth2 import id_token as google_id_token
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Where verify_oauth2_token downloads Google's signing certificates.
+GOOGLE_CERTS_URL = 'https://www.googleapis.com/oauth2/v1/certs'
+
+_MAX_AGE = re.compile(r'max-age=(\d+)')
+
+
+def _create_session():
+    session = requests.Session()
+    # Retry only failed connections. The authorization code can be used once, so a POST that reached Google
+    # must not be sent again.
+    retries = Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.1, allowed_methods=None)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retries)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.hooks['response'].append(metrics.record_http)
+    return session
+
+
+# Shared by every request handled by this worker. requests.Session is safe to share between threads for this use.
+SESSION = _create_session()
+
+
+class CachingRequest(google_requests.Request):
+    '''
+    google.auth transport that caches successful GET responses for their Cache-Control max-age.
+    Used for the certificate endpoint, which Google serves with a max-age of several hours.
+    Arguments:
+        session: requests.Session
+    '''
+    def __init__(self, session=None):
+        super().__init__(session=session)
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, url, method='GET', body=None, headers=None, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = current_app.config['HTTP_TIMEOUT']
+        if method != 'GET':
+            return super().__call__(url, method=method, body=body, headers=headers, timeout=timeout, **kwargs)
+        with self._lock:
+            cached = self._cache.get(url)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+        response = super().__call__(url, method=method, body=body, headers=headers, timeout=timeout, **kwargs)
+        if response.status == 200:
+            match = _MAX_AGE.search(response.headers.get('Cache-Control', ''))
+            if match and 'no-store' not in response.headers.get('Cache-Control', ''):
+                with self._lock:
+                    self._cache[url] = (time.monotonic() + int(match.group(1)), response)
+        return response
+
+    def cached(self, url):
+        '''
+        Check if a response for url is cached and hasn't expired.
+        '''
+        with self._lock:
+            cached = self._cache.get(url)
+        return bool(cached) and cached[0] > time.monotonic()
+
+    def clear(self):
+        '''
+        Drop every cached response.
+        '''
+        with self._lock:
+            self._cache.clear()
+
+
+REQUEST = CachingRequest(session=SESSION)
+
+
+def exchange_code(code):
+    '''
+    Exchange an authorization code for tokens.
+    Arguments:
+        code: str
+    Returns:
+        dict: tokens, including id_token on success
+    Raises:
+        requests.RequestException on network errors and timeouts
+    '''
+    config = current_app.config
+    data = {
+        "code": code,
+        "client_id": config['GOOGLE_AUTH_CLIENT_ID'],
+        "client_secret": config['GOOGLE_AUTH_CLIENT_SECRET'],
+        "redirect_uri": config['GOOGLE_AUTH_REDIRECT_URIS'][0],
+        "grant_type": "authorization_code"
+    }
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
+    response = SESSION.post(config['GOOGLE_AUTH_TOKEN_URI'], headers=headers, data=data, timeout=config['HTTP_TIMEOUT'])
+    return response.json()
+
+
+def verify_id_token(id_token):
+    '''
+    Verify a Google ID token with the cached signing certificates.
+    Arguments:
+        id_token: str
+    Returns:
+        dict: id_info
+    Raises:
+        ValueError if the token is invalid
+    '''
+    return google_id_token.verify_oauth2_token(id_token, REQUEST, current_app.config['GOOGLE_AUTH_CLIENT_ID'])
+
+
+def prefetch_certs():
+    '''
+    Load Google's signing certificates into the cache ahead of the first login.
+    Raises:
+        google.auth.exceptions.TransportError: if the certificates can't be fetched
+    '''
+    REQUEST(GOOGLE_CERTS_URL, method='GET')
+
+
+def certs_cached():
+    '''
+    Check if Google's signing certificates are cached, so verifying a token needs no request.
+    Returns:
+        bool
+    '''
+    return REQUEST.cached(GOOGLE_CERTS_URL)
@@ -0,0 +1,77 @@
+'''
+OAuth 2.0 state tokens that can be verified without storage. Replaces the state kind in datastore.
+A state is "<nonce>.<issued at>.<signature>", where the signature is an HMAC-SHA256 of the nonce and timestamp
+with STATE_SECRET. The callback checks the signature and age. Used nonces are remembered in a per-worker TTL set
+so a state can't be replayed against the same worker.
+Functions: issue_state, verify_state
+Exceptions: verify_state returns the reason a state was rejected, None if it is valid.
+'''
+import base64, hashlib, hmac, secrets, threading, time
+from cachetools import TTLCache
+from flask import current_app
+
+# Nonces remembered per worker. Sized for login bursts, entries are evicted once the state would have expired.
+USED_NONCES_SIZE = 65536
+
+# Tolerated clock difference between instances for states issued "in the future".
+CLOCK_SKEW = 60
+
+_used_nonces = None
+_lock = threading.Lock()
+
+
+def _secret():
+    secret = current_app.config.get('STATE_SECRET')
+    if not secret:
+        # Every instance has the same private key, so a secret derived from it verifies across instances.
+        secret = hashlib.sha256(b'oauth-state|' + (current_app.config['PRIVATE_KEY'] or '').encode()).hexdigest()
+    return secret.encode()
+
+
+def _sign(payload):
+    digest = hmac.new(_secret(), payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).decode().rstrip('=')
+
+
+def issue_state():
+    '''
+    Generate a signed, timestamped state for OAuth2.0 authorization.
+    Returns:
+        str: state
+    '''
+    payload = f'{secrets.token_urlsafe(16)}.{int(time.time())}'
+    return f'{payload}.{_sign(payload)}'
+
+
+def verify_state(state):
+    '''
+    Verify a state returned by the OAuth callback and mark it as used.
+    Arguments:
+        state: str
+    Returns:
+        None if the state is valid
+        str: 'invalid', 'expired' or 'replayed'
+    '''
+    global _used_nonces
+    # compare_digest only takes ASCII strings, and isdigit accepts digits int can't parse.
+    parts = state.split('.') if isinstance(state, str) and state.isascii() else []
+    if len(parts) != 3 or not parts[1].isdigit():
+        return 'invalid'
+    nonce, issued, signature = parts
+    if not hmac.compare_digest(signature, _sign(f'{nonce}.{issued}')):
+        return 'invalid'
+
+    ttl = current_app.config['STATE_TTL']
+    age = time.time() - int(issued)
+    if age > ttl:
+        return 'expired'
+    if age < -CLOCK_SKEW:
+        return 'invalid'
+
+    with _lock:
+        if _used_nonces is None:
+            _used_nonces = TTLCache(maxsize=USED_NONCES_SIZE, ttl=ttl)
+        if nonce in _used_nonces:
+            return 'replayed'
+        _used_nonces[nonce] = True
+    return None
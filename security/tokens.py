@@ -0,0 +1,94 @@
+'''
+JWT verification shared by the authorization decorators and utils.verify_JWT.
+The public key is parsed once in the app factory (PUBLIC_KEY_OBJECT). Verified tokens are cached by their SHA-256
+hash until they expire, so a client that sends the same token on every request only pays for RSA verification once.
+Functions: load_public_key, load_private_key, verify_token, clear_cache
+Exceptions: ExpiredSignatureError, InvalidTokenError (raised by verify_token).
+'''
+import hashlib, threading, time
+import jwt
+from cachetools import TTLCache
+from cryptography.hazmat.primitives import serialization
+from flask import current_app
+from jwt.exceptions import ExpiredSignatureError, InvalidTokenError
+
+# Verified tokens kept per worker, and the longest time one is trusted without verifying it again.
+CACHE_SIZE = 4096
+CACHE_TTL = 300
+
+_cache = TTLCache(maxsize=CACHE_SIZE, ttl=CACHE_TTL)
+_lock = threading.Lock()
+
+
+def load_public_key(pem):
+    '''
+    Parse a PEM encoded public key.
+    Arguments:
+        pem: str
+    Returns:
+        cryptography public key object
+        None if pem is empty or invalid
+    '''
+    if not pem:
+        return None
+    try:
+        return serialization.load_pem_public_key(pem.encode())
+    except ValueError:
+        return None
+
+
+def load_private_key(pem):
+    '''
+    Parse a PEM encoded private key. Signing with a parsed key skips the key checks that make up most of the
+    cost of jwt.encode with a PEM string.
+    Arguments:
+        pem: str
+    Returns:
+        cryptography private key object
+        None if pem is empty or invalid
+    '''
+    if not pem:
+        return None
+    try:
+        return serialization.load_pem_private_key(pem.encode(), password=None)
+    except (TypeError, ValueError):
+        return None
+
+
+def verify_token(token):
+    '''
+    Verify a JWT signed with the app's private key.
+    Arguments:
+        token: str
+    Returns:
+        dict: decoded claims
+    Raises:
+        ExpiredSignatureError if the token has expired
+        InvalidTokenError if the token is invalid or no public key is configured
+    '''
+    digest = hashlib.sha256(token.encode()).digest()
+    with _lock:
+        claims = _cache.get(digest)
+    if claims is not None:
+        # The cache may outlive the token.
+        if 'exp' in claims and claims['exp'] <= time.time():
+            with _lock:
+                _cache.pop(digest, None)
+            raise ExpiredSignatureError('Signature has expired')
+        return claims
+
+    public_key = current_app.config.get('PUBLIC_KEY_OBJECT')
+    if public_key is None:
+        raise InvalidTokenError('Public key not found')
+    claims = jwt.decode(token, public_key, algorithms=[current_app.config['JWT_ALGORITHM']])
+    with _lock:
+        _cache[digest] = claims
+    return claims
+
+
+def clear_cache():
+    '''
+    Forget every verified token, e.g. after rotating the key pair.
+    '''
+    with _lock:
+        _cache.clear()
@@ -0,0 +1,127 @@
+'''
+Response serialization helpers shared by the routes.
+Clients that send Accept: application/x-ndjson get plans streamed one JSON document per line. Nothing is
+collected into a list first, so memory and time to first byte don't grow with the catalog.
+Clients can ask for a subset of plan properties with ?fields=name,carrier,... to cut payload size.
+Functions: plan_document, wants_ndjson, ndjson_response, iter_query, fetch_page, requested_fields, select_fields
+'''
+import datetime
+from flask import Response, current_app, request
+from google.api_core import exceptions
+
+NDJSON = 'application/x-ndjson'
+
+# Added by the routes, not stored on the plan. Always returned so clients can follow up on a plan.
+LINK_FIELDS = ('id', 'self')
+
+
+def plan_document(plan, base_url):
+    '''
+    Convert a plan entity into the plain dict sent to clients, with its id and self link.
+    Datetimes become ISO 8601 strings here, so serializing the plan needs no fallback for datastore's datetime type.
+    Arguments:
+        plan: datastore.Entity
+        base_url: str, e.g. SELF_URL
+    Returns:
+        dict: plan
+    '''
+    document = {name: value.isoformat() if isinstance(value, datetime.datetime) else value
+                for name, value in plan.items()}
+    document['id'] = plan.id
+    document['self'] = f'{base_url}plans/{plan.id}'
+    return document
+
+
+def wants_ndjson():
+    '''
+    Check if the client prefers NDJSON over JSON. JSON stays the default for */* and missing Accept headers.
+    Returns:
+        bool
+    '''
+    return request.accept_mimetypes.best_match(['application/json', NDJSON]) == NDJSON
+
+
+def ndjson_response(items, status=200, headers=None):
+    '''
+    Stream items as NDJSON. Items are serialized one at a time as the response is sent.
+    The generator runs after the view returns, so items must not depend on the request context.
+    Arguments:
+        items: iterable of JSON serializable objects, may be a generator
+        status: int
+        headers: dict (optional)
+    Returns:
+        flask.Response
+    '''
+    dumps = current_app.json.dumps
+
+    def generate():
+        for item in items:
+            yield dumps(item) + '\n'
+
+    return Response(generate(), status=status, headers=headers, mimetype=NDJSON)
+
+
+def iter_query(query):
+    '''
+    Iterate a datastore query one page at a time. Only the current page is held in memory.
+    Arguments:
+        query: datastore.Query
+    Returns:
+        generator of entities
+    '''
+    for page in query.fetch().pages:
+        yield from page
+
+
+def fetch_page(query, limit, cursor=None):
+    '''
+    Fetch one page of a datastore query, starting where the previous page ended.
+    Arguments:
+        query: datastore.Query
+        limit: int, page size
+        cursor: str (optional) datastore cursor returned with the previous page
+    Returns:
+        tuple: list of entities, cursor of the next page (None on the last page)
+    Raises:
+        ValueError: if datastore rejects the cursor
+    '''
+    iterator = query.fetch(limit=limit, start_cursor=cursor)
+    try:
+        entities = list(iterator)
+    except exceptions.BadRequest as e:
+        raise ValueError(f'Invalid cursor: {e}')
+    # A full page can still be the last one. The next page is then empty and has no cursor.
+    token = iterator.next_page_token if len(entities) == limit else None
+    return entities, token.decode() if isinstance(token, bytes) else token
+
+
+def requested_fields():
+    '''
+    Get the plan properties requested with the fields query parameter.
+    Returns:
+        list: field names
+        None if every property was requested
+    '''
+    value = request.args.get('fields')
+    if not value:
+        return None
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    return fields or None
+
+
+def select_fields(plan, fields):
+    '''
+    Keep only the requested properties of a plan, plus id and self.
+    Arguments:
+        plan: dict
+        fields: list or None
+    Returns:
+        dict: plan
+    '''
+    if fields is None:
+        return plan
+    selected = {field: plan[field] for field in fields if field in plan}
+    for field in LINK_FIELDS:
+        if field in plan:
+            selected[field] = plan[field]
+    return selected
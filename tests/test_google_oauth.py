@@ -0,0 +1,95 @@
+'''
+Tests of the outbound calls to Google in security/google_oauth.py against the local stub in benchmarks/stub_google.py.
+Covers keep-alive connections, the certificate cache and the timeouts.
+Run from the project root: python -m unittest discover tests
+'''
+import os, sys, time, unittest
+from unittest import mock
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS))
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS), 'benchmarks'))
+import requests
+from flask import Flask
+from google.oauth2 import id_token as google_id_token
+from security import google_oauth
+import stub_google
+
+CLIENT_ID = 'test-client'
+
+
+class GoogleOAuthTest(unittest.TestCase):
+
+    def start_stub(self, **kwargs):
+        '''
+        Start a stub and point the token exchange and the certificate downloads at it.
+        Every stub has its own port, so it starts without pooled connections.
+        '''
+        stub = stub_google.StubGoogle(CLIENT_ID, **kwargs)
+        url = stub.start()
+        self.addCleanup(stub.stop)
+        self.app.config['GOOGLE_AUTH_TOKEN_URI'] = f'{url}/token'
+        for target, name in ((google_oauth, 'GOOGLE_CERTS_URL'), (google_id_token, '_GOOGLE_OAUTH2_CERTS_URL')):
+            patcher = mock.patch.object(target, name, f'{url}/certs')
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return stub
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update({
+            'GOOGLE_AUTH_CLIENT_ID': CLIENT_ID,
+            'GOOGLE_AUTH_CLIENT_SECRET': 'secret',
+            'GOOGLE_AUTH_REDIRECT_URIS': ['http://localhost/callback'],
+            'HTTP_TIMEOUT': (3.05, 10),
+        })
+        context = self.app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        google_oauth.REQUEST.clear()
+        self.addCleanup(google_oauth.REQUEST.clear)
+
+    def login(self, sub):
+        tokens = google_oauth.exchange_code(sub)
+        return google_oauth.verify_id_token(tokens['id_token'])
+
+    def test_logins_share_one_connection(self):
+        stub = self.start_stub()
+        for sub in ('1', '2', '3'):
+            self.assertEqual(self.login(sub)['sub'], sub)
+        self.assertEqual(stub.requests, {'token': 3, 'certs': 1})
+        self.assertEqual(stub.connections, 1)
+
+    def test_certs_cached_for_max_age(self):
+        stub = self.start_stub(certs_max_age=1)
+        self.assertFalse(google_oauth.certs_cached())
+        google_oauth.prefetch_certs()
+        self.assertTrue(google_oauth.certs_cached())
+        self.login('1')
+        self.assertEqual(stub.requests['certs'], 1)
+
+        time.sleep(1.1)
+        self.assertFalse(google_oauth.certs_cached())
+        self.login('2')
+        self.assertEqual(stub.requests['certs'], 2)
+        self.assertTrue(google_oauth.certs_cached())
+
+    def test_certs_not_cached_without_max_age(self):
+        stub = self.start_stub(certs_max_age=0)
+        self.login('1')
+        self.login('2')
+        self.assertEqual(stub.requests['certs'], 2)
+
+    def test_slow_token_exchange_times_out(self):
+        stub = self.start_stub(latency=1.0)
+        self.app.config['HTTP_TIMEOUT'] = (3.05, 0.2)
+        start = time.monotonic()
+        with self.assertRaises(requests.RequestException):
+            google_oauth.exchange_code('1')
+        self.assertLess(time.monotonic() - start, 0.9)
+        # The code can be used once, a POST that reached Google isn't sent again.
+        self.assertEqual(stub.requests['token'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
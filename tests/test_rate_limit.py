@@ -0,0 +1,304 @@
+'''
+Tests of the rate limiting in rate_limit.py and of the coalescing of identical /recommend requests.
+The recommend test boots main.py against the in-memory datastore in benchmarks/fake_datastore.py.
+Run from the project root: python -m unittest discover tests
+'''
+import os, sys, threading, time, unittest
+from unittest import mock
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS))
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS), 'benchmarks'))
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from flask import Flask
+from google.cloud import datastore
+import fake_datastore, pricing, rate_limit
+
+
+class Clock:
+    '''
+    Stands in for the time module in rate_limit, so buckets refill when the test says so.
+    '''
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+class StandInBackend:
+    '''
+    Backend set with set_backend. Records every take and answers with wait.
+    '''
+    def __init__(self, wait=0):
+        self.wait = wait
+        self.takes = []
+
+    def take(self, key, rate, burst):
+        self.takes.append((key, rate, burst))
+        if isinstance(self.wait, Exception):
+            raise self.wait
+        return self.wait
+
+
+class StandInRedis:
+    '''
+    Stands in for redis.Redis: register_script returns a callable that records its keys and args.
+    '''
+    def __init__(self, result):
+        self.result = result
+        self.calls = []
+
+    def register_script(self, script):
+        self.script = script
+
+        def run(keys, args):
+            self.calls.append((keys, args))
+            return self.result
+        return run
+
+
+def create_app(hops=1):
+    app = Flask(__name__)
+    app.config.update({
+        'RATE_LIMITS': {'test': (1, 2)},
+        'RATE_LIMIT_REDIS_URL': None,
+        'RATE_LIMIT_MEMORY_KEYS': 100,
+        'RATE_LIMIT_PROXY_HOPS': hops,
+    })
+    rate_limit.init_app(app)
+
+    @app.route('/limited')
+    @rate_limit.limit('test')
+    def limited():
+        return {'ip': rate_limit.client_ip()}
+
+    @app.route('/unlimited')
+    @rate_limit.limit('other')
+    def unlimited():
+        return {}
+
+    return app
+
+
+class MemoryBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch.object(rate_limit, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.backend = rate_limit.MemoryBackend()
+
+    def test_burst_then_wait(self):
+        self.assertEqual(self.backend.take('a', 1, 2), 0)
+        self.assertEqual(self.backend.take('a', 1, 2), 0)
+        self.assertAlmostEqual(self.backend.take('a', 1, 2), 1)
+        # Other keys have their own bucket.
+        self.assertEqual(self.backend.take('b', 1, 2), 0)
+
+    def test_refill(self):
+        for _ in range(2):
+            self.backend.take('a', 2, 2)
+        self.clock.now += 0.25
+        self.assertAlmostEqual(self.backend.take('a', 2, 2), 0.25)
+        self.clock.now += 0.25
+        self.assertEqual(self.backend.take('a', 2, 2), 0)
+        # A long pause refills the bucket up to the burst size only.
+        self.clock.now += 60
+        for _ in range(2):
+            self.assertEqual(self.backend.take('a', 2, 2), 0)
+        self.assertGreater(self.backend.take('a', 2, 2), 0)
+
+    def test_dropped_bucket_is_full(self):
+        backend = rate_limit.MemoryBackend(maxsize=1)
+        for _ in range(2):
+            backend.take('a', 1, 2)
+        backend.take('b', 1, 2)
+        self.assertEqual(backend.take('a', 1, 2), 0)
+
+
+class LimitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch.object(rate_limit, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.app = create_app()
+        self.http = self.app.test_client()
+
+    def get(self, path='/limited', forwarded=None, remote='10.0.0.1'):
+        headers = {'X-Forwarded-For': forwarded} if forwarded else {}
+        return self.http.get(path, headers=headers, environ_base={'REMOTE_ADDR': remote})
+
+    def test_429_with_retry_after(self):
+        for _ in range(2):
+            self.assertEqual(self.get().status_code, 200)
+        response = self.get()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.get_json(), rate_limit.ERROR_429)
+        self.assertEqual(response.headers['Retry-After'], '1')
+
+        self.clock.now += 1
+        self.assertEqual(self.get().status_code, 200)
+
+    def test_routes_without_a_limit(self):
+        for _ in range(5):
+            self.assertEqual(self.get('/unlimited').status_code, 200)
+
+    def test_clients_have_their_own_buckets(self):
+        for _ in range(2):
+            self.get(remote='10.0.0.1')
+        self.assertEqual(self.get(remote='10.0.0.1').status_code, 429)
+        self.assertEqual(self.get(remote='10.0.0.2').status_code, 200)
+
+    def test_spoofed_forwarded_for_shares_the_bucket(self):
+        # The client controls everything before the address the load balancer appended.
+        for spoofed in ('1.1.1.1', '2.2.2.2'):
+            self.assertEqual(self.get(forwarded=f'{spoofed}, 203.0.113.7, 10.1.1.1').status_code, 200)
+        self.assertEqual(self.get(forwarded='3.3.3.3, 203.0.113.7, 10.1.1.1').status_code, 429)
+        self.assertEqual(self.get(forwarded='203.0.113.8, 10.1.1.1').status_code, 200)
+
+
+class ClientIPTest(unittest.TestCase):
+
+    def client_ip(self, hops, forwarded=None, remote='10.0.0.1'):
+        app = create_app(hops)
+        headers = {'X-Forwarded-For': forwarded} if forwarded else {}
+        with app.test_request_context('/', headers=headers, environ_base={'REMOTE_ADDR': remote}):
+            return rate_limit.client_ip()
+
+    def test_hops_from_the_end(self):
+        forwarded = '1.1.1.1, 203.0.113.7, 10.1.1.1'
+        self.assertEqual(self.client_ip(0, forwarded), '10.1.1.1')
+        self.assertEqual(self.client_ip(1, forwarded), '203.0.113.7')
+        self.assertEqual(self.client_ip(2, forwarded), '1.1.1.1')
+
+    def test_remote_addr_without_enough_entries(self):
+        self.assertEqual(self.client_ip(1, '203.0.113.7'), '10.0.0.1')
+        self.assertEqual(self.client_ip(3, '1.1.1.1, 203.0.113.7, 10.1.1.1'), '10.0.0.1')
+
+    def test_remote_addr_without_header(self):
+        self.assertEqual(self.client_ip(1, remote='192.0.2.1'), '192.0.2.1')
+
+
+class BackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app()
+        self.http = self.app.test_client()
+
+    def get(self):
+        return self.http.get('/limited', headers={'X-Forwarded-For': '203.0.113.7, 10.1.1.1'})
+
+    def test_stand_in_backend(self):
+        backend = StandInBackend()
+        rate_limit.set_backend(self.app, backend)
+        self.assertEqual(self.get().status_code, 200)
+        self.assertEqual(backend.takes, [('test:203.0.113.7', 1, 2)])
+
+        backend.wait = 2.5
+        response = self.get()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '3')
+
+    def test_failing_backend_lets_requests_through(self):
+        rate_limit.set_backend(self.app, StandInBackend(wait=ConnectionError('redis is down')))
+        with mock.patch('builtins.print'):
+            self.assertEqual(self.get().status_code, 200)
+
+    def test_redis_backend(self):
+        redis = StandInRedis(b'0')
+        rate_limit.set_backend(self.app, rate_limit.RedisBackend(redis))
+        self.assertEqual(self.get().status_code, 200)
+        self.assertEqual(redis.calls, [(['rate:test:203.0.113.7'], [1, 2])])
+
+        redis.result = b'0.4'
+        response = self.get()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '1')
+
+
+def _keys():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                serialization.NoEncryption()).decode()
+    public = key.public_key().public_bytes(serialization.Encoding.PEM,
+                                           serialization.PublicFormat.SubjectPublicKeyInfo).decode()
+    return private, public
+
+
+class RecommendCoalescingTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        private, public = _keys()
+        environment = mock.patch.dict(os.environ, {'PRIVATE_KEY': private, 'PUBLIC_KEY': public,
+                                                   'GOOGLE_AUTH_CLIENT_ID': 'test-client',
+                                                   'GOOGLE_AUTH_CLIENT_SECRET': 'test-secret'})
+        environment.start()
+        cls.addClassCleanup(environment.stop)
+        # The app creates the shared datastore client on first use, every datastore.Client() returns the fake.
+        cls.datastore = fake_datastore.FakeClient()
+        client = mock.patch.object(datastore, 'Client', lambda *args, **kwargs: cls.datastore)
+        client.start()
+        cls.addClassCleanup(client.stop)
+        import main
+        cls.main = main
+
+    def setUp(self):
+        plan = datastore.Entity(self.datastore.key('plans', 1))
+        price = {'1': '$65', '2': '$120'}
+        plan.update({'name': 'Plan', 'carrier': 'Verizon', 'data': 50, 'hotspot': 10, 'talk': 99999,
+                     'text': 99999, 'price': price, 'price_table': pricing.build_price_table(price),
+                     'networks': ['5G'], 'payoff': False, 'description': 'Plan', 'url': 'https://example.com'})
+        self.datastore.put(plan)
+        self.main.catalog.invalidate()
+        # Precomputed responses would answer without computing, and their builds would be counted.
+        for name, value in (('profiles', self.main.recommend_profiles.ProfileStore({})),
+                            ('recommend_results', self.main.recommend_cache.ResultCache(maxsize=10)),
+                            ('recommend_inflight', self.main.recommend_cache.SingleFlight())):
+            patcher = mock.patch.object(self.main, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        limits = mock.patch.dict(self.main.app.config, {'RATE_LIMITS': {}})
+        limits.start()
+        self.addCleanup(limits.stop)
+
+    def test_identical_requests_share_one_computation(self):
+        inflight = self.main.recommend_inflight
+        build = self.main.recommend_profiles.build_response
+        builds = []
+
+        def slow_build(engine, params):
+            builds.append(params)
+            # Hold the first computation until the second request waits on it.
+            deadline = time.monotonic() + 5
+            while not inflight.coalesced and time.monotonic() < deadline:
+                time.sleep(0.01)
+            return build(engine, params)
+
+        responses = [None, None]
+
+        def post(i):
+            http = self.main.app.test_client()
+            responses[i] = http.post('/recommend', json={'lines': 2, 'data': 20})
+
+        with mock.patch.object(self.main.recommend_profiles, 'build_response', slow_build):
+            threads = [threading.Thread(target=post, args=(i,)) for i in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(10)
+
+        self.assertEqual(len(builds), 1)
+        self.assertEqual(inflight.coalesced, 1)
+        self.assertEqual([response.status_code for response in responses], [200, 200])
+        self.assertEqual(responses[0].get_json(), responses[1].get_json())
+        self.assertEqual([plan['id'] for plan in responses[0].get_json()['results']], [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
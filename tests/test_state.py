@@ -0,0 +1,114 @@
+'''
+Tests of the signed OAuth states in security/state.py.
+Run from the project root: python -m unittest discover tests
+'''
+import os, sys, time, unittest
+from unittest import mock
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS))
+from flask import Flask
+from security import state
+
+
+def create_app(secret='state-secret', private_key='private-key'):
+    app = Flask(__name__)
+    app.config.update({'STATE_SECRET': secret, 'PRIVATE_KEY': private_key, 'STATE_TTL': 3600})
+    return app
+
+
+class StateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app()
+        context = self.app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+
+    def issue_at(self, seconds):
+        '''
+        Issue a state as if the clock was seconds ahead (negative for the past).
+        '''
+        with mock.patch.object(state.time, 'time', return_value=time.time() + seconds):
+            return state.issue_state()
+
+    def test_valid(self):
+        self.assertIsNone(state.verify_state(state.issue_state()))
+
+    def test_tampered_signature(self):
+        nonce, issued, signature = state.issue_state().split('.')
+        tampered = ('A' if signature[0] != 'A' else 'B') + signature[1:]
+        self.assertEqual(state.verify_state(f'{nonce}.{issued}.{tampered}'), 'invalid')
+        self.assertEqual(state.verify_state(f'{nonce}.{issued}.'), 'invalid')
+
+    def test_tampered_timestamp(self):
+        nonce, issued, signature = state.issue_state().split('.')
+        self.assertEqual(state.verify_state(f'{nonce}.{int(issued) + 1}.{signature}'), 'invalid')
+        # Stretching the lifetime of an old state.
+        old = self.issue_at(-7200)
+        nonce, issued, signature = old.split('.')
+        self.assertEqual(state.verify_state(f'{nonce}.{int(time.time())}.{signature}'), 'invalid')
+
+    def test_tampered_nonce(self):
+        nonce, issued, signature = state.issue_state().split('.')
+        self.assertEqual(state.verify_state(f'x{nonce}.{issued}.{signature}'), 'invalid')
+
+    def test_expired(self):
+        self.assertEqual(state.verify_state(self.issue_at(-3601)), 'expired')
+        self.assertIsNone(state.verify_state(self.issue_at(-3500)))
+
+    def test_issued_in_the_future(self):
+        self.assertEqual(state.verify_state(self.issue_at(state.CLOCK_SKEW + 10)), 'invalid')
+        # Within the tolerated clock difference between instances.
+        self.assertIsNone(state.verify_state(self.issue_at(state.CLOCK_SKEW - 10)))
+
+    def test_replayed(self):
+        issued = state.issue_state()
+        self.assertIsNone(state.verify_state(issued))
+        self.assertEqual(state.verify_state(issued), 'replayed')
+
+    def test_rejected_state_is_not_marked_used(self):
+        issued = state.issue_state()
+        nonce, timestamp, signature = issued.split('.')
+        self.assertEqual(state.verify_state(f'{nonce}.{timestamp}.x{signature}'), 'invalid')
+        self.assertIsNone(state.verify_state(issued))
+
+    def test_malformed(self):
+        for malformed in (None, 123, '', 'abc', 'a.b', 'a.b.c', 'a.1.b.c', 'a.-1.b', 'a. 1.b', '..',
+                          'a.1.\u00e9', 'a.\u00b2.b'):
+            with self.subTest(state=malformed):
+                self.assertEqual(state.verify_state(malformed), 'invalid')
+
+
+class SecretTest(unittest.TestCase):
+
+    def issue(self, app):
+        with app.app_context():
+            return state.issue_state()
+
+    def verify(self, app, issued):
+        with app.app_context():
+            return state.verify_state(issued)
+
+    def test_secret_derived_from_private_key(self):
+        # Instances without STATE_SECRET share the private key, so they verify each other's states.
+        issued = self.issue(create_app(secret=None, private_key='key'))
+        self.assertIsNone(self.verify(create_app(secret=None, private_key='key'), issued))
+
+    def test_derived_secret_depends_on_private_key(self):
+        issued = self.issue(create_app(secret=None, private_key='key'))
+        self.assertEqual(self.verify(create_app(secret=None, private_key='other key'), issued), 'invalid')
+
+    def test_derived_secret_is_not_the_private_key(self):
+        # A state signed with the private key itself as the secret must not verify.
+        issued = self.issue(create_app(secret='key'))
+        self.assertEqual(self.verify(create_app(secret=None, private_key='key'), issued), 'invalid')
+
+    def test_state_secret_takes_precedence(self):
+        issued = self.issue(create_app(secret='secret', private_key='key'))
+        self.assertEqual(self.verify(create_app(secret=None, private_key='key'), issued), 'invalid')
+        self.assertIsNone(self.verify(create_app(secret='secret', private_key='other key'), issued))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,77 +1,137 @@
 '''
 This file contains utility functions that are used by the main application or are one time use functions.
-Functions: generate_state, create_user, generate_custom_jwt, generate_key_pair, get_expiration, verify_JWT, get_date_time.
+Functions: create_user, get_user_roles, generate_custom_jwt, generate_key_pair, get_expiration, verify_JWT, get_date_time,
+           encode_cursor, decode_cursor, delete_expired_states, convert_to_int_db, build_price_table_db, key_users_by_sub_db.
 Exceptions: All functions return 0 if error occurs.
 '''
-import random, string, jwt, datetime
+import jwt, datetime, base64, json, threading, time
+from cachetools import TTLCache
 from flask import current_app as app
 
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
 
 from google.cloud import datastore
+import clients, plan_cache, pricing
+from security import tokens
 
-client = datastore.Client()
+# Shared with every module and created on first use, see clients.py.
+client = clients.LazyClient()
 
+# Users whose roles are kept per worker for repeat logins.
+ROLES_CACHE_SIZE = 4096
+_roles_cache = None
+_roles_lock = threading.Lock()
 
-def generate_state():
+
+def create_user(id_info):
     '''
-    Generate a random state string for OAuth2.0 authorization.
+    Get the user from the database, creating it if it doesn't exist. New users are assigned the role 'user'.
+    Users are keyed by their Google sub. The lookup and the put run in one transaction, so two first logins
+    at the same time create a single user.
+    Users stored with generated ids before users were keyed by sub are moved to the new key on their first
+    login, keeping their roles.
+    Arguments:
+        id_info: dict
+    Returns:
+        datastore.Entity: user entity
+        0 if error occurs
     '''
-    return ''.join(random.choices(string.ascii_letters + string.digits, k=16))
+    required_fields = ["sub", "email", "name"]
+    for field in required_fields:
+        if field not in id_info:
+            return 0
+    key = client.key('users', id_info["sub"])
+    try:
+        # Queries can't run inside the transaction, so the old users are read first.
+        legacy = _legacy_users(id_info["sub"])
+        with client.transaction():
+            user = client.get(key)
+            created = user is None
+            if created:
+                user = datastore.Entity(key)
+                if legacy:
+                    user.update(legacy[0])
+                else:
+                    user.update({
+                        "sub": id_info["sub"],
+                        "email": id_info["email"],
+                        "name": id_info["name"],
+                        "roles": ["user"]
+                    })
+            if legacy:
+                _merge_roles(user, legacy)
+            if created or legacy:
+                client.put(user)
+        if legacy:
+            client.delete_multi([old.key for old in legacy])
+        return user
+    except:
+        # The transaction loses if another login created the user first. Use the winner's user.
+        try:
+            return client.get(key) or 0
+        except:
+            return 0
 
 
-def create_user(id_info):
+def _legacy_users(sub):
+    # Users stored with generated ids have no key name.
+    query = client.query(kind='users')
+    query.add_filter(filter=datastore.query.PropertyFilter('sub', '=', sub))
+    return [user for user in query.fetch() if user.key.name is None]
+
+
+def _merge_roles(user, others):
+    roles = list(user.get('roles') or [])
+    for other in others:
+        roles += [role for role in other.get('roles', []) if role not in roles]
+    user['roles'] = roles or ["user"]
+
+
+def get_user_roles(id_info):
     '''
-    Create a new user in the database. The user is assigned the role 'user' by default.
+    Get the roles of a user, creating the user on first login. Roles are cached for USER_ROLES_CACHE_TTL seconds,
+    so repeat logins skip the database. Role changes in the database apply after the cache expires.
     Arguments:
         id_info: dict
     Returns:
-        datastore.Entity: user entity
+        list: roles
         0 if error occurs
     '''
+    global _roles_cache
+    sub = id_info.get("sub")
+    with _roles_lock:
+        if _roles_cache is None:
+            _roles_cache = TTLCache(maxsize=ROLES_CACHE_SIZE, ttl=app.config['USER_ROLES_CACHE_TTL'])
+        roles = _roles_cache.get(sub)
+    if roles is not None:
+        return roles
+
     try:
-        new_user = datastore.Entity(client.key('users'))
-        required_fields = ["sub", "email", "name"]
-        for field in required_fields:
-            if field not in id_info:
-                return 0
-        new_user.update({
-            "sub": id_info["sub"],
-            "email": id_info["email"],
-            "name": id_info["name"],
-            "roles": ["user"]
-        })
-        client.put(new_user)
-        return new_user
+        user = client.get(client.key('users', sub))
     except:
         return 0
+    if user is None:
+        user = create_user(id_info)
+        if user == 0:
+            return 0
+    # Role is set to user by default. Changing this requires manual admin action.
+    roles = list(user.get('roles') or ["user"])
+    with _roles_lock:
+        _roles_cache[sub] = roles
+    return roles
 
 
 def generate_custom_jwt(id_info):
     '''
     Generate a custom JWT token for the user.
     '''
-    SECRET_KEY = app.config['SECRET_KEY']
-
-    # Check if user exists in database
-    query = client.query(kind='users')
-    query.add_filter(filter=datastore.query.PropertyFilter('sub', '=', id_info["sub"]))
-    results = list(query.fetch())
+    SECRET_KEY = app.config.get('PRIVATE_KEY_OBJECT') or app.config['SECRET_KEY']
 
-    if not results:
-        # Create user with role user
-        user = create_user(id_info)
-        if user == 0:
-            return 0
-        # Role is set to user by default. Changing this requires manual admin action.
-        roles = ["user"]
-    elif len(results) > 1:
+    # Get the user's roles. A new user will be created if the user does not exist.
+    roles = get_user_roles(id_info)
+    if roles == 0:
         return 0
-    elif 'roles' not in results[0]:
-        roles = ["user"]
-    else:
-        roles = results[0]['roles']
 
     # Refresh token will be added later
     payload = {
@@ -103,9 +163,9 @@ def verify_JWT(token):
     '''
     Verify the JWT token.
     '''
-    PUBLIC_KEY = app.config['PUBLIC_KEY']
     try:
-        decoded = jwt.decode(token, PUBLIC_KEY, algorithms=["RS256"])
+        # Shares the parsed public key and the verified token cache with the auth decorators.
+        tokens.verify_token(token)
         return 1
     # If we want more specific error messages, we can catch the exceptions separately (expired, invalid). If needed add here.
     except:
@@ -125,6 +185,73 @@ def get_date_time(date_time=None):
         return 0
 
 
+def encode_cursor(position):
+    '''
+    Encode a paging position into an opaque cursor for the client.
+    Arguments:
+        position: dict
+    Returns:
+        str: cursor
+    '''
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(cursor):
+    '''
+    Decode a cursor made by encode_cursor.
+    Arguments:
+        cursor: str
+    Returns:
+        dict: position
+        0 if the cursor is invalid
+    '''
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(position.get('offset'), int) or position['offset'] < 0:
+            return 0
+        return position
+    except:
+        return 0
+
+
+def delete_expired_states(batch_size=500, pause=0.5, max_seconds=300):
+    '''
+    Delete expired OAuth states from the database. States are read with a keys only query and deleted in batches.
+    The pause between batches limits the write rate and max_seconds keeps a run inside the request deadline.
+    Arguments:
+        batch_size: int, keys per delete_multi, at most 500
+        pause: float, seconds to wait between batches
+        max_seconds: float, stop starting new batches after this long
+    Returns:
+        dict: deleted, batches, seconds, finished (False if stopped by max_seconds)
+    '''
+    start = time.monotonic()
+    deleted = 0
+    batches = 0
+    finished = False
+    while time.monotonic() - start < max_seconds:
+        query = client.query(kind='state')
+        query.add_filter(filter=datastore.query.PropertyFilter('expiration', '<', get_date_time()))
+        query.keys_only()
+        # Deleted states drop out of the query, so every batch starts from the beginning.
+        keys = [entity.key for entity in query.fetch(limit=batch_size)]
+        if not keys:
+            finished = True
+            break
+        client.delete_multi(keys)
+        deleted += len(keys)
+        batches += 1
+        if len(keys) < batch_size:
+            finished = True
+            break
+        time.sleep(pause)
+    return {
+        "deleted": deleted,
+        "batches": batches,
+        "seconds": round(time.monotonic() - start, 3),
+        "finished": finished
+    }
+
 
 # The following functions are one time use functions for development purposes only.
 def generate_key_pair():
@@ -167,7 +294,7 @@ def convert_to_int_db():
     '''
     This function is a one time use function for use during development for bugs that cause data to be stored as strings.
     Check that all values in data, talk, text, and hotspot coloumns are integers in plans.
-    This checks the entire plans table.
+    This checks the entire plans table. The catalog version is bumped, so workers reload their cached plans.
     '''
     query = client.query(kind='plans')
     results = list(query.fetch())
@@ -176,4 +303,63 @@ def convert_to_int_db():
             if not isinstance(plan[field], int):
                 plan[field] = int(plan[field])
         client.put(plan)
+    plan_cache.PlanCatalog(client).bump_version([(plan.id, 'patch') for plan in results])
     return "All values converted to integers."
+
+
+def build_price_table_db():
+    '''
+    This function is a one time use function to backfill price_table for plans created before it existed.
+    price_table is the numeric version of price that recommendations filter and sort on.
+    This checks the entire plans table. Plans with a price that can't be parsed are listed and left unchanged.
+    The catalog version is bumped, so workers reload their cached plans.
+    '''
+    query = client.query(kind='plans')
+    results = list(query.fetch())
+    updated = []
+    invalid = []
+    for plan in results:
+        price_table = pricing.build_price_table(plan.get('price'))
+        if price_table == 0:
+            invalid.append(plan.id)
+            continue
+        if plan.get('price_table') != price_table:
+            plan['price_table'] = price_table
+            updated.append(plan)
+    # Datastore accepts at most 500 entities per commit.
+    for start in range(0, len(updated), 500):
+        client.put_multi(updated[start:start + 500])
+    if updated:
+        plan_cache.PlanCatalog(client).bump_version([(plan.id, 'patch') for plan in updated])
+    return f"{len(updated)} plans updated. Plans with an invalid price: {invalid}"
+
+
+def key_users_by_sub_db():
+    '''
+    This function is a one time use function to move users stored with generated ids to keys named by their sub.
+    Logins move a user when it first logs in, this moves every user at once.
+    Users with the same sub are merged into one user with the roles of all of them.
+    This checks the entire users table.
+    '''
+    query = client.query(kind='users')
+    results = list(query.fetch())
+    merged = {}
+    old_keys = []
+    for user in results:
+        if user.key.name is not None or 'sub' not in user:
+            continue
+        old_keys.append(user.key)
+        sub = user['sub']
+        if sub not in merged:
+            existing = client.get(client.key('users', sub))
+            merged[sub] = existing or datastore.Entity(client.key('users', sub))
+            if existing is None:
+                merged[sub].update(user)
+        _merge_roles(merged[sub], [user])
+    updated = list(merged.values())
+    # Datastore accepts at most 500 entities per commit.
+    for start in range(0, len(updated), 500):
+        client.put_multi(updated[start:start + 500])
+    for start in range(0, len(old_keys), 500):
+        client.delete_multi(old_keys[start:start + 500])
+    return f"{len(updated)} users keyed by sub. {len(old_keys)} old users removed."